@@ -21,14 +21,27 @@ import os
 import random
 import math
 import re
+import hashlib
+import json
+import time
+import tarfile
+import io
+import zlib
+import struct
+import threading
+import concurrent.futures
+import collections
+import itertools
 
 
 import mathutils
+import numpy as np
 from math import radians, tan
 
 from bpy.props import (StringProperty, BoolProperty, IntProperty, FloatProperty, FloatVectorProperty, EnumProperty, PointerProperty )
 
-os.system("cls")
+if os.name == 'nt' and not bpy.app.background:
+    os.system("cls")
 
 
 
@@ -36,10 +49,11 @@ os.system("cls")
 ###################################
 ## Default config
 class ConfigPaths():
-    output = "D:\\ofigen\\_Data\\"
-    models = "D:\\ofigen\\MultiModels\\"
-    bounds = "D:\\ofigen\\Bounding\\"
-    background = "D:\\ofigen\\Background\\"
+    root = "D:\\ofigen\\" if os.name == 'nt' else os.path.join(os.path.expanduser("~"), "ofigen", "")
+    output = os.path.join(root, "_Data", "")
+    models = os.path.join(root, "MultiModels", "")
+    bounds = os.path.join(root, "Bounding", "")
+    background = os.path.join(root, "Background", "")
 
 
 ###################################
@@ -51,6 +65,33 @@ CAM_NAME = "a_CAM"
 LAMP_NAME = "b_LAMP"
 SUN_NAME = "b_SUN"
 IMG_NAME = "c_IMG"
+LIB_NAME = "z_LIB"
+LOD_SUFFIX = ".LOD"
+
+FIRST_TARGET_ID = 10000001
+
+PASS_COMBINE_NAME = "ofigen_pass_combine"
+PASS_VIEWER_NAME = "ofigen_pass_viewer"
+VIEWER_IMAGE = "Viewer Node"
+
+FLOW_TAG = 202021.25
+FLOW_UNKNOWN = 1e10
+DEPTH_FAR = 1e9
+
+MANIFEST_NAME = "samples.jsonl"
+CALIBRATION_NAME = "calibration.json"
+METRICS_NAME = "metrics.jsonl"
+METRICS_SUMMARY_NAME = "metrics_summary.json"
+CONFIG_PREFIX = "config_"
+ANNOTATION_PREFIX = "annotations_"
+TAR_PREFIX = "shard-"
+TAR_INDEX_NAME = "shards.jsonl"
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ofigen")
+BACKGROUND_CACHE_DIR = os.path.join(CACHE_DIR, "backgrounds")
+
+CAM_LOCATION = (0, 0, 0)
+CAM_ROTATION = (radians(90), radians(0), radians(0))
 
 
 BBOX = 'BOX'
@@ -60,10 +101,30 @@ BSPHERE = 'SPH'
 ###################################
 ## Globals
 
-TARGET_OBJECTS = []
-IDS = [10000000]
 FILES = None
 
+MODEL_LIBRARY = {}
+MODEL_LIBRARY_STATS = {'hits': 0, 'misses': 0, 'baked': 0}
+BAKED_LIBRARY = {}
+LOD_LIBRARY = {}
+BOUND_LIBRARY = {}
+BACKGROUND_POOL = collections.OrderedDict()
+BACKGROUND_POOL_STATS = {'hits': 0, 'misses': 0}
+BACKGROUND_CACHE = {}
+
+MANIFEST_WRITERS = {}
+ANNOTATION_WRITERS = {}
+TAR_WRITERS = {}
+OUTPUT_POOL = None
+WEBP_SUPPORT = {}
+RENDER_SNAPSHOTS = {}
+SAMPLE_METRICS = {'stages': {}, 'counts': {}}
+RUN_METRICS = []
+RUN_DATA_POINTERS = {}
+
+ASSET_INDEX = {}
+ASSET_LISTS = {}
+
 
 ###################################
 ## Gui/app variables
@@ -95,6 +156,53 @@ class AddonData(bpy.types.PropertyGroup):
     is_random_number_of_models = bpy.props.BoolProperty( name = 'Is Random Number of Models',  default=True,  description='Random number of models.')
     is_randomize_the_use_of_models = bpy.props.BoolProperty( name = 'Random use of models',  default=True,  description='Random use of models, otherwise use it iteratively. ')
     is_randomize_the_use_of_images = bpy.props.BoolProperty( name = 'Random use of backgrounds',  default=True,  description='Random use of backgrounds, otherwise use it iteratively.')
+    is_model_library_used = bpy.props.BoolProperty( name = 'Model library',  default=True,  description='Import each model file only once per session and deploy the targets as linked duplicates of it.')
+    is_lod_used = bpy.props.BoolProperty( name = 'Level of detail',  default=False,  description='Deploy far targets as decimated variants of their model (half the faces per level), chosen from the projected size of the target at its placement distance. Only with the model library.')
+    lod_levels  = bpy.props.IntProperty( name = "LOD levels", default = 3, min=1, max=8, description = "Number of decimated variants per model. The last one keeps 0.5^levels of the faces.")
+    lod_radius  = bpy.props.FloatProperty( name = "Full detail radius (px)", default = 256, min=1, description = "Projected radius of a target (pixels) from which it is deployed with the full mesh. Every halving of the covered image area below it drops one level.")
+    lod_min_faces  = bpy.props.IntProperty( name = "LOD minimum faces", default = 2000, min=0, description = "Models with fewer faces are always deployed with the full mesh.")
+    is_baked_library_used = bpy.props.BoolProperty( name = 'Baked library',  default=False,  description='Append the models from the baked .blend library of the model directory (see Bake model library) instead of importing them. Models missing from it or changed since the bake are imported.')
+    is_overlay_rendered = bpy.props.BoolProperty( name = 'Render bounding overlays',  default=True,  description='Render the extra images with the bounding objects (.1b, .2b). The projected bounding data is written into the annotations either way.')
+    is_flow_output = bpy.props.BoolProperty( name = 'Optical flow',  default=False,  description='Write the dense ground truth optical flow of the two snapshots (.flo). It is computed from the depth and object index passes of the first snapshot and the known motion of the objects.')
+    is_flow_occlusion = bpy.props.BoolProperty( name = 'Occlusion',  default=True,  description='Write the occlusion mask of the flow (.occ.npy, 1 = the pixel is not visible in the second snapshot).')
+    is_flow_depth = bpy.props.BoolProperty( name = 'Depth',  default=False,  description='Write the depth maps of the two snapshots (.1.depth.npy, .2.depth.npy).')
+    is_animation_render = bpy.props.BoolProperty( name = 'Render as animation',  default=False,  description='Keyframe the two snapshots on frame 1 and 2 and render them with one animation job instead of two still renders.')
+    is_persistent_data = bpy.props.BoolProperty( name = 'Persistent data',  default=False,  description='Keep the render data between the renders (Cycles), so the unchanged parts of the scene are not synced again. Otherwise the setting of the .blend file is kept.')
+    is_background_pool_used = bpy.props.BoolProperty( name = 'Background pool',  default=False,  description='Keep one background plane and only swap its image. The decoded images are kept in a pool (least recently used ones are dropped first), so a background used again is not loaded again.')
+    background_pool_size  = bpy.props.IntProperty( name = "Pool size", default = 8, min=1, max=1000, description = "Maximum number of background images kept in the pool.")
+    background_pool_budget  = bpy.props.IntProperty( name = "Pool budget (MB)", default = 512, min=1, description = "Maximum size of the decoded background images kept in the pool.")
+    is_background_cache_used = bpy.props.BoolProperty( name = 'Background cache',  default=False,  description='Load the backgrounds from a cache of copies downscaled to the render resolution (uncompressed TGA, in ~/.cache/ofigen/backgrounds). A missing copy is created on first use, or for every background with Preprocess backgrounds.')
+    background_cache_margin  = bpy.props.FloatProperty( name = "Cache margin", default = 1.25, min=1.0, max=4.0, description = "Size of the cached backgrounds relative to the render resolution. The shorter side of the image covers the render resolution times the margin, larger images are not upscaled.")
+    is_persistent_rig = bpy.props.BoolProperty( name = 'Persistent rig',  default=False,  description='Keep the camera, the lamps and the background plane between the runs and only reset them, instead of clearing and rebuilding the whole scene.')
+    annotation_backend = bpy.props.EnumProperty( name = "Annotations", default = 'JSONL', description = "Where the annotations of the samples are written. The sample manifest (samples.jsonl) is written either way, with the NumPy shards only it holds no frame data.",
+        items = [('JSONL', "JSON Lines", "One JSON record per sample in samples.jsonl."),
+                 ('NPZ', "NumPy shards", "Fixed dtype arrays of the samples and the targets, one compressed .npz shard per N samples."),
+                 ('BOTH', "Both", "JSON Lines records and NumPy shards.")])
+    is_tar_output = bpy.props.BoolProperty( name = 'Tar shards',  default=False,  description='Pack the files and the record of every finished sample into rolling tar shards (shard-<first index>.tar) with an index of the members (shards.jsonl), so the dataset can be read sequentially.')
+    tar_shard_size  = bpy.props.IntProperty( name = "Shard size (MB)", default = 1024, min=1, max=65536, description = "A new tar shard is started once the current one reaches this size. The samples are never split between shards.")
+    is_tar_loose_deleted = bpy.props.BoolProperty( name = 'Delete loose files',  default=True,  description='Delete the files of a sample once they are packed into a tar shard.')
+    orphan_purge_interval  = bpy.props.IntProperty( name = "Purge interval", default = 1, min=0, max=1000, description = "Remove the meshes, materials, textures, images, lamps, cameras and actions without users after every N samples. (0: never)")
+    memory_limit  = bpy.props.IntProperty( name = "Memory limit (MB)", default = 0, min=0, description = "When the resident memory of Blender exceeds this after a sample, the model and bounding libraries are cleared and the orphans are removed. (0: no limit)")
+    render_profile = bpy.props.EnumProperty( name = "Render profile", default = 'CUSTOM', description = "Render settings applied before every render: resolution scale, samples, light bounces, tiles, threads, simplify and denoising. Custom keeps the settings of the .blend file.",
+        items = [('CUSTOM', "Custom", "The render settings of the .blend file."),
+                 ('DRAFT', "Draft", "50% resolution, few samples and bounces, simplified scene, denoised."),
+                 ('PREVIEW', "Preview", "75% resolution, moderate samples and bounces, denoised."),
+                 ('PRODUCTION', "Production", "Full resolution, many samples and bounces.")])
+    calibration_psnr  = bpy.props.FloatProperty( name = "Min PSNR (dB)", default = 35.0, min=10.0, max=100.0, description = "Calibration picks the fastest profile whose image is at least this close (PSNR) to the production render of the same scene.")
+    is_async_output = bpy.props.BoolProperty( name = 'Background writer',  default=False,  description='Encode and write the output on a pool of writer threads, so the next snapshot is set up and rendered meanwhile. The images are captured from the compositor (Viewer node); with optical flow, another view than Default/Raw, a look, curves or 8 bit dither the images are written by Blender and only the other outputs go to the pool. Renders the snapshots as stills.')
+    output_threads  = bpy.props.IntProperty( name = "Writer threads", default = 2, min=1, max=32, description = "Number of writer threads of the background writer.")
+    output_queue_size  = bpy.props.IntProperty( name = "Queue size", default = 8, min=1, max=256, description = "Maximum number of outputs waiting for the writer threads. The run waits when the queue is full (one full resolution float image each).")
+    image_format = bpy.props.EnumProperty( name = "Image format", default = 'SCENE', description = "File format of the rendered images.",
+        items = [('SCENE', "Scene", "The output settings of the .blend file (format, color depth, compression). The background writer encodes PNG and OpenEXR itself, Blender writes the other formats."),
+                 ('PNG', "PNG", "Lossless PNG."),
+                 ('EXR', "OpenEXR", "Linear, not color managed OpenEXR."),
+                 ('WEBP', "WebP", "Lossless WebP. Needs the background writer and Pillow (PIL), otherwise PNG is written.")])
+    image_color_depth = bpy.props.EnumProperty( name = "Color depth", default = '8', description = "Bits per channel. PNG is written with 8 or 16 (32 means 16), OpenEXR with 16 (half) or 32 (float).",
+        items = [('8', "8", "8 bits per channel."),
+                 ('16', "16", "16 bits per channel."),
+                 ('32', "32", "32 bits per channel.")])
+    png_compression  = bpy.props.IntProperty( name = "PNG compression", default = 1, min=0, max=9, description = "Zlib level of the PNG images. (0: none, fastest; 9: smallest, slowest)")
+    annotation_shard_size  = bpy.props.IntProperty( name = "Shard size", default = 1000, min=1, max=100000, description = "Number of samples in one NumPy annotation shard. The last shard of a run is written with the samples it has.")
     
 
     is_init_target_moving = bpy.props.BoolProperty( name = 'Are the targets rotating at init? ',  default=True,  description='If enabled the targets are rotated randomly after init.')
@@ -126,7 +234,9 @@ class AddonData(bpy.types.PropertyGroup):
 
 
 
-    run_iterations  = bpy.props.IntProperty( name = "Iterations", default = 1, min=1, max=100, description = "Number of times the program creates data. (one takes aprx. 4s)")
+    run_iterations  = bpy.props.IntProperty( name = "Iterations", default = 1, min=1, max=100, description = "Number of times the program creates data. The time of every sample and stage is written to metrics.jsonl.")
+    run_seed  = bpy.props.IntProperty( name = "Seed", default = 0, min=0, description = "Seed of the run. Every sample is generated from the seed and its index, so any sample can be regenerated on its own.")
+    is_resume = bpy.props.BoolProperty( name = 'Resume',  default=False,  description='Keep the output folder and skip the samples that are already complete on disk.')
 
 
     # private vars
@@ -135,94 +245,280 @@ class AddonData(bpy.types.PropertyGroup):
 
 
     def getModelFileNames(self):        
-        models = []
+        key = ('models', self.data_path_objs, self.is_format_stl, self.is_format_obj, self.is_format_ply, self.is_format_3ds, self.is_shape_box, self.is_shape_sphere, self.filename_model_tag)
+        if key in ASSET_LISTS:
+            return ASSET_LISTS[key]
 
-        for root, dirs, files in os.walk(self.data_path_objs):
-            for name in files:
-
-                ok_format = False
-                if self.is_format_stl and ('.stl' in name):
-                    ok_format = True
-                elif self.is_format_obj and ('.obj' in name):
-                    ok_format = True
-                elif self.is_format_ply and ('.ply' in name):
-                    ok_format = True
-                elif self.is_format_3ds and ('.3ds' in name):
-                    ok_format = True
-                
-                ok_shape = False
-                if self.is_shape_box and (BBOX in name):
-                    ok_shape = True
-                elif self.is_shape_sphere and (BSPHERE in name):
-                    ok_shape = True
-                
-                has_substr = False
-                if self.filename_model_tag in name:
-                    has_substr = True
-
-                if ok_format and ok_shape and has_substr:
-                    models.append(os.path.join(root, name))
+        models = []
 
+        for path in getAssetFiles(self.data_path_objs):
+            name = os.path.basename(path)
+
+            ok_format = False
+            if self.is_format_stl and ('.stl' in name):
+                ok_format = True
+            elif self.is_format_obj and ('.obj' in name):
+                ok_format = True
+            elif self.is_format_ply and ('.ply' in name):
+                ok_format = True
+            elif self.is_format_3ds and ('.3ds' in name):
+                ok_format = True
+            
+            ok_shape = False
+            if self.is_shape_box and (BBOX in name):
+                ok_shape = True
+            elif self.is_shape_sphere and (BSPHERE in name):
+                ok_shape = True
+            
+            has_substr = False
+            if self.filename_model_tag in name:
+                has_substr = True
+
+            if ok_format and ok_shape and has_substr:
+                models.append(path)
+
+        ASSET_LISTS[key] = models
         return models
 
     def getBackgroundFileNames(self):
+        key = ('backgrounds', self.data_path_imgs, self.filename_background_tag)
+        if key in ASSET_LISTS:
+            return ASSET_LISTS[key]
+
         images = []
 
-        for root, dirs, files in os.walk(self.data_path_imgs):
-            for name in files:                
-                has_substr = False
-                if self.filename_background_tag in name:
-                    has_substr = True
+        for path in getAssetFiles(self.data_path_imgs):
+            name = os.path.basename(path)
 
-                if has_substr:
-                    images.append(os.path.join(root, name))
+            has_substr = False
+            if self.filename_background_tag in name:
+                has_substr = True
 
+            if has_substr:
+                images.append(path)
+
+        ASSET_LISTS[key] = images
         return images
 
 
     def getBoundFileNames(self, boundingtag):
+        key = ('bounds', self.data_path_bounds, boundingtag, self.is_shape_box, self.is_shape_sphere)
+        if key in ASSET_LISTS:
+            return ASSET_LISTS[key]
+
         bounds = []
 
-        for root, dirs, files in os.walk(self.data_path_bounds):  
-            for name in files:                             
-                ok_format = False
-                if ('.obj' in name):
-                    ok_format = True
+        for path in getAssetFiles(self.data_path_bounds):
+            name = os.path.basename(path)
+
+            ok_format = False
+            if ('.obj' in name):
+                ok_format = True
 
-                ok_shape = False
-                if boundingtag == BBOX and self.is_shape_box and (BBOX in name):
-                    ok_shape = True
-                elif boundingtag == BSPHERE and self.is_shape_sphere and (BSPHERE in name):
-                    ok_shape = True
+            ok_shape = False
+            if boundingtag == BBOX and self.is_shape_box and (BBOX in name):
+                ok_shape = True
+            elif boundingtag == BSPHERE and self.is_shape_sphere and (BSPHERE in name):
+                ok_shape = True
 
-                if ok_shape and ok_format:
-                    bounds.append(os.path.join(root, name))
+            if ok_shape and ok_format:
+                bounds.append(path)
 
+        ASSET_LISTS[key] = bounds
         return bounds
 
 
 
 
+###################################
+## Asset index
+
+# The file lists of the asset directories are scanned once and persisted in
+# the cache directory. An index is reused as long as the modification time
+# of none of its directories changed.
+def getAssetIndexPath(directory):
+    return os.path.join(CACHE_DIR, "index_" + hashlib.sha1(directory.encode('utf-8')).hexdigest() + ".json")
+
+def scanAssetDirectory(directory):
+    dirs = {}
+    files = []
+    for root, subdirs, names in os.walk(directory):
+        dirs[root] = os.path.getmtime(root)
+        for name in names:
+            files.append(os.path.join(root, name))
+    return {'directory': directory, 'dirs': dirs, 'files': sorted(files)}
+
+def isAssetIndexValid(index):
+    try:
+        for path, mtime in index['dirs'].items():
+            if os.path.getmtime(path) != mtime:
+                return False
+    except OSError:
+        return False
+    return len(index['dirs']) > 0
+
+def loadAssetIndex(directory):
+    try:
+        with open(getAssetIndexPath(directory), 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+# Written under a temporary name, so parallel workers never read a partial index.
+def saveAssetIndex(index):
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        path = getAssetIndexPath(index['directory'])
+        tmpPath = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmpPath, 'w') as fh:
+            json.dump(index, fh)
+        os.replace(tmpPath, path)
+    except (IOError, OSError):
+        print("\nCouldn't save the asset index of ", index['directory'])
+
+def indexAssetDirectory(directory, refresh=False):
+    directory = os.path.abspath(directory)
+    index = None if refresh else ASSET_INDEX.get(directory)
+    if index == None and not refresh:
+        index = loadAssetIndex(directory)
+    if index == None or not isAssetIndexValid(index):
+        index = scanAssetDirectory(directory)
+        saveAssetIndex(index)
+    ASSET_INDEX[directory] = index
+    return index
+
+def getAssetFiles(directory):
+    index = ASSET_INDEX.get(os.path.abspath(directory))
+    if index == None:
+        index = indexAssetDirectory(directory)
+    return index['files']
+
+# Called once per run, the lookups during the run are not validated again.
+def refreshAssetIndex(context, force=False):
+    addonData = context.scene.addon_data
+    ASSET_LISTS.clear()
+    for directory in (addonData.data_path_objs, addonData.data_path_imgs, addonData.data_path_bounds):
+        indexAssetDirectory(directory, force)
+
+
+
+
 ###################################
 ## Local types
 
 class BBoxData:
    def __init__(self, trgt):
+        rotation_mode = trgt.rotation_mode
         trgt.rotation_mode = 'XYZ'
         self.location = trgt.location
         self.dimensions = trgt.dimensions
         self.rotation_euler = trgt.rotation_euler
         self.delta_location = trgt.delta_location
         self.delta_rotation_euler = trgt.delta_rotation_euler
-        self.radius = math.sqrt(math.pow(trgt.dimensions[0], 2) + math.pow(trgt.dimensions[1], 2) + math.pow(trgt.dimensions[2], 2))*0.5
-        trgt.rotation_mode = 'QUATERNION'
+        self.radius = getBoundingRadius(trgt.dimensions)
+        trgt.rotation_mode = rotation_mode
+
+
+def getBoundingRadius(dimensions):
+    return math.sqrt(math.pow(dimensions[0], 2) + math.pow(dimensions[1], 2) + math.pow(dimensions[2], 2))*0.5
 
 
-class DeployedObjData:
-   def __init__(self, name, location, radius):
+# Deployed targets and obstacles (the camera) by name. A target is recorded
+# when its object is created and placed once its location is known: the
+# centers and radii of the placed entries are kept in arrays for the
+# placement test. A removed entry is replaced by the last one of the arrays,
+# so adding, looking up and removing are O(1).
+class TargetRecord:
+   __slots__ = ('name', 'bound', 'id', 'index')
+
+   def __init__(self, name, bound, id, index=None):
         self.name = name
-        self.location = location
-        self.radius = radius
+        self.bound = bound
+        self.id = id
+        self.index = index
+
+
+class TargetRegistry:
+   def __init__(self, capacity=64):
+        self.records = collections.OrderedDict()
+        self.placed = []
+        self.centers = np.zeros((capacity, 3))
+        self.radii = np.zeros(capacity)
+        self.ids = itertools.count(FIRST_TARGET_ID)
+
+   def __len__(self):
+        return len(self.records)
+
+   def __contains__(self, name):
+        return name in self.records
+
+   def get(self, name):
+        return self.records.get(name)
+
+   def nextID(self):
+        return next(self.ids)
+
+   def addTarget(self, name, bound, id):
+        self.remove(name)
+        self.records[name] = TargetRecord(name, bound, id)
+
+   def place(self, name, location, radius):
+        record = self.records.get(name)
+        if record == None:
+            record = TargetRecord(name, None, None)
+            self.records[name] = record
+        if record.index == None:
+            if len(self.placed) == len(self.radii):
+                self.centers = np.concatenate((self.centers, np.zeros_like(self.centers)))
+                self.radii = np.concatenate((self.radii, np.zeros_like(self.radii)))
+            record.index = len(self.placed)
+            self.placed.append(name)
+        self.centers[record.index] = tuple(location)
+        self.radii[record.index] = radius
+
+   def addObstacle(self, name, location, radius):
+        self.place(name, location, radius)
+
+   def remove(self, name):
+        record = self.records.pop(name, None)
+        if record == None or record.index == None:
+            return
+        last = len(self.placed) - 1
+        if record.index != last:
+            moved = self.placed[last]
+            self.placed[record.index] = moved
+            self.centers[record.index] = self.centers[last]
+            self.radii[record.index] = self.radii[last]
+            self.records[moved].index = record.index
+        self.placed.pop()
+
+   # The ids start again, the objects of the old ones are removed.
+   def clear(self):
+        self.records.clear()
+        del self.placed[:]
+        self.ids = itertools.count(FIRST_TARGET_ID)
+
+   def getTargets(self):
+        return [record for record in self.records.values() if record.bound != None]
+
+   def getTargetNames(self):
+        return [record.name for record in self.getTargets()]
+
+   def getPlacementArrays(self):
+        count = len(self.placed)
+        return self.centers[:count], self.radii[:count]
+
+
+TARGETS = TargetRegistry()
+
+# The targets still in the scene, in the order they were deployed.
+def getDeployedTargetNames(context):
+    objects = context.scene.objects
+    return [name for name in TARGETS.getTargetNames() if name in objects]
+
+def getBoundingBoxName(boxName, record):
+    return boxName + '.' + record.bound + '.' + str(record.id)
 
 
 
@@ -234,19 +530,49 @@ def getBBoxDataInvisible(trgtName):
     bbox = BBoxData(trgt)
     return bbox
 
-def addBoundingBox(context, trgtName, boxName, type):
-    bboxData = getBBoxDataInvisible(trgtName)
+# The bounding shapes are imported once and kept out of the scene like the
+# models of the library, the bounding objects are linked duplicates of them.
+def getBoundTemplate(context, type):
+    addonData = context.scene.addon_data
+    key = (type, addonData.data_path_bounds)
+
+    name = BOUND_LIBRARY.get(key)
+    if name != None and name in bpy.data.objects:
+        return bpy.data.objects[name]
 
     if type == BSPHERE:
-        filePath = context.scene.addon_data.getBoundFileNames(BSPHERE)[0]   
+        filePath = addonData.getBoundFileNames(BSPHERE)[0]   
     else: # BBOX
-        filePath = context.scene.addon_data.getBoundFileNames(BBOX)[0]   
+        filePath = addonData.getBoundFileNames(BBOX)[0]   
 
     bpy.ops.import_scene.obj(filepath=filePath, filter_glob="*.obj;*.mtl")
-    for obj in bpy.context.selected_objects:
-        obj.name = boxName 
-        bbox = bpy.context.scene.objects[boxName]
+    bpy.context.scene.objects.active = bpy.context.selected_objects[0]
+    if len(bpy.context.selected_objects) > 1:
+        bpy.ops.object.join()
+
+    template = bpy.context.scene.objects.active
+    template.name = LIB_NAME + '.' + BBOX_NAME + '.' + type
+    template.use_fake_user = True
+    bpy.context.scene.objects.unlink(template)
+    BOUND_LIBRARY[key] = template.name
+    return template
 
+def clearBoundLibrary():
+    for name in BOUND_LIBRARY.values():
+        removeLibraryObject(name)
+    BOUND_LIBRARY.clear()
+
+def addBoundingBox(context, trgtName, boxName, type):
+    bboxData = getBBoxDataInvisible(trgtName)
+
+    bbox = bpy.context.scene.objects.get(boxName)
+    if bbox == None:
+        bbox = getBoundTemplate(context, type).copy()
+        bbox.name = boxName
+        bpy.context.scene.objects.link(bbox)
+
+    bbox.hide = False
+    bbox.hide_render = False
     bbox.location = bboxData.location 
     bbox.dimensions = bboxData.dimensions*1.01 
     bbox.rotation_euler = bboxData.rotation_euler 
@@ -254,26 +580,136 @@ def addBoundingBox(context, trgtName, boxName, type):
     bbox.delta_rotation_euler = bboxData.delta_rotation_euler 
 
 def removeBoundingBox(context, boxName):
-    bpy.context.scene.objects[boxName].select = True
-    bpy.ops.object.delete() 
+    removeObjectsByName([boxName])
 
 def addBoundingBoxForAll(context, trgtName, boxName):
-    for obj in bpy.context.scene.objects:
-        if obj.name.startswith(trgtName):
-            objID = obj.name.split('.')[2]
-            objBound = obj.name.split('.')[1]
-            addBoundingBox(context, obj.name, boxName + '.' + objBound + '.' + objID, objBound)
+    for name in getDeployedTargetNames(context):
+        record = TARGETS.get(name)
+        if name.startswith(trgtName):
+            addBoundingBox(context, name, getBoundingBoxName(boxName, record), record.bound)
 
 def removeBoundingBoxForAll(context,boxName):
-    for obj in bpy.context.scene.objects:
-        if obj.name.startswith(boxName):
-            removeBoundingBox(context, obj.name)
+    removeObjectsByName([getBoundingBoxName(boxName, record) for record in TARGETS.getTargets()])
+
+# Keeps the bounding objects for the next snapshot, addBoundingBoxForAll
+# moves them onto the targets again and makes them visible.
+def hideBoundingBoxForAll(context, boxName):
+    for record in TARGETS.getTargets():
+        obj = bpy.context.scene.objects.get(getBoundingBoxName(boxName, record))
+        if obj != None:
+            obj.hide = True
+            obj.hide_render = True
+
+
+
+
+#############################
+# Projection (image space annotations)
+
+BLENDER_TO_CV = np.diag([1.0, -1.0, -1.0])
+
+def getCameraIntrinsics(scene, cam):
+    camData = cam.data
+    scale = scene.render.resolution_percentage / 100.0
+    width = scene.render.resolution_x * scale
+    height = scene.render.resolution_y * scale
+    pixelAspect = scene.render.pixel_aspect_y / scene.render.pixel_aspect_x
+
+    sensorFit = camData.sensor_fit
+    sensorSize = camData.sensor_width
+    if sensorFit == 'AUTO':
+        sensorFit = 'HORIZONTAL' if width >= height * pixelAspect else 'VERTICAL'
+    elif sensorFit == 'VERTICAL':
+        sensorSize = camData.sensor_height
+
+    viewFac = width if sensorFit == 'HORIZONTAL' else height * pixelAspect
+    pixelSize = sensorSize / camData.lens / viewFac
+
+    fx = 1.0 / pixelSize
+    fy = fx / pixelAspect
+    cx = width / 2.0 - camData.shift_x * viewFac
+    cy = height / 2.0 + camData.shift_y * viewFac / pixelAspect
+
+    K = np.array([[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]])
+    return K, int(round(width)), int(round(height))
+
+def getCameraExtrinsics(cam):
+    worldToCam = np.array(cam.matrix_world.inverted())
+    return BLENDER_TO_CV.dot(worldToCam[:3])
+
+# Pixel coordinates with the origin in the top left corner of the image.
+def projectPoints(P, points):
+    proj = points.dot(P[:, :3].T) + P[:, 3]
+    depth = proj[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv = proj[:, :2] / depth[:, None]
+    return uv, depth
+
+def toWorld(obj, points):
+    m = np.array(obj.matrix_world)
+    return points.dot(m[:3, :3].T) + m[:3, 3]
+
+def getWorldVertices(obj):
+    vertices = obj.data.vertices
+    co = np.empty(len(vertices) * 3, dtype=np.float32)
+    vertices.foreach_get('co', co)
+    return toWorld(obj, co.reshape(-1, 3).astype(np.float64))
+
+def getWorldBoundBox(obj):
+    return toWorld(obj, np.array([tuple(corner) for corner in obj.bound_box]))
+
+class ProjectionData:
+   def __init__(self, bbox2d, bbox3d, sphere, visible):
+        self.bbox2d = bbox2d
+        self.bbox3d = bbox3d
+        self.sphere = sphere
+        self.visible = visible
+
+# The vertices and the bounding box corners of all the targets are projected
+# in one batch, the results are split per target afterwards.
+def projectTargets(scene, cam, trgtNames):
+    projections = {}
+    if len(trgtNames) == 0:
+        return projections
+
+    K, width, height = getCameraIntrinsics(scene, cam)
+    P = K.dot(getCameraExtrinsics(cam))
+    objs = [bpy.data.objects[name] for name in trgtNames]
+
+    vertices = [getWorldVertices(obj) for obj in objs]
+    offsets = np.cumsum([0] + [len(v) for v in vertices[:-1]])
+    uv, depth = projectPoints(P, np.concatenate(vertices))
+    uv[depth <= 0] = np.nan
+    mins = np.fmin.reduceat(uv, offsets, axis=0)
+    maxs = np.fmax.reduceat(uv, offsets, axis=0)
+
+    corners = np.array([getWorldBoundBox(obj) for obj in objs])
+    cornersUV, cornersDepth = projectPoints(P, corners.reshape(-1, 3))
+    cornersUV = cornersUV.reshape(-1, 8, 2)
+
+    centers = corners.mean(axis=1)
+    radii = np.array([getBBoxDataInvisible(name).radius for name in trgtNames])
+    centersUV, centersDepth = projectPoints(P, centers)
+    camCenter = np.array(cam.matrix_world.translation)
+    dist = np.linalg.norm(centers - camCenter, axis=1)
+    with np.errstate(invalid='ignore'):
+        radiiUV = K[0, 0] * radii / np.sqrt(np.maximum(dist * dist - radii * radii, 1e-9))
+
+    for i, name in enumerate(trgtNames):
+        x0, y0 = np.clip(mins[i], 0, (width, height))
+        x1, y1 = np.clip(maxs[i], 0, (width, height))
+        visible = bool(x1 > x0 and y1 > y0)
+        bbox2d = (x0, y0, x1, y1) if visible else (0.0, 0.0, 0.0, 0.0)
+        sphere = (centersUV[i][0], centersUV[i][1], radiiUV[i]) if centersDepth[i] > 0 else (0.0, 0.0, 0.0)
+        projections[name] = ProjectionData(bbox2d, cornersUV[i], sphere, visible)
+
+    return projections
 
 
 
 
 #############################
-# WRITE FILE + TEXT FORMATING
+# WRITE FILE + ANNOTATION RECORDS
 
 def writeOutput(context, textArray, filename):
     dir_out = context.scene.addon_data.data_path_out;
@@ -285,183 +721,753 @@ def writeOutput(context, textArray, filename):
 def floatFormat(num):
     return "{:.2f}".format(num)
 
-def intFormat(num):
-    return "{:.0f}".format(num)
-
-def boolFormat(b):
-    return "true" if b else "false"
-    
-
-def floatParamIntoJSON(name, data, indent=2, comma=True):
-    return ' ' * indent + '"' + name + '": ' + floatFormat(data) + (',\n' if comma else '\n')
-
-def intParamIntoJSON(name, data, indent=2, comma=True):
-    return ' ' * indent + '"' + name + '": ' + intFormat(data) + (',\n' if comma else '\n')
 
-def boolParamIntoJSON(name, data, indent=2, comma=True):
-    return ' ' * indent + '"' + name + '": ' + boolFormat(data) + (',\n' if comma else '\n')
+# NaN and inf (e.g. points behind the camera) are not valid JSON, they become null.
+def jsonFloat(num):
+    num = float(num)
+    return num if math.isfinite(num) else None
 
-def stringParamIntoJSON(name, data, indent=2, comma=True):
-    return ' ' * indent + '"' + name + '": "' + data + '"' + (',\n' if comma else '\n')
+def vectorToList(vec):
+    return [jsonFloat(v) for v in vec]
 
+def matrixToList(matrix):
+    return [vectorToList(row) for row in matrix]
 
-def vectorToJSON(name, vec, indent=6, comma=True):
-    return ' ' * indent + '"' + name + '": [' + floatFormat(vec[0]) + ', ' + floatFormat(vec[1]) + ', ' + floatFormat(vec[2]) + ']' + (',\n' if comma else '\n')
+def eulerToDict(euler, compensate=True):
+    return {"value": [euler.x - (radians(90) if compensate else radians(0)), euler.y, euler.z], "order": euler.order}
 
-def eulerToJSON(name, euler, indent=6, comma=True, compensate=True):
-    return ' ' * indent + '"' + name + '": {"value":[' + floatFormat(euler.x - (radians(90) if compensate else radians(0))) + ', ' + floatFormat(euler.y) + ', ' + floatFormat(euler.z) + '], "order":"' + euler.order + '"}' + (',\n' if comma else '\n')
-
-def matrixToJSON(name, matrix):
-    rows = [""] * 4
-    for x in range(0, 4):
-        rows[x] = '[' + floatFormat(matrix[x][0])  + ', ' + floatFormat(matrix[x][1]) + ', ' + floatFormat(matrix[x][2]) + ', ' + floatFormat(matrix[x][3]) +  ']'
-    return '"' + name + '": [' + rows[0] + ', ' + rows[1] + ', ' + rows[2] + ', ' + rows[3] + ']'
-
-def bboxDataToJSON(cam, trgtName, indent):
+def bboxDataToJSON(cam, trgtName, projection=None):
     bboxData = getBBoxDataInvisible(trgtName)
-    
-    alltext = []
-    alltext.append(' ' * indent + '{"' + trgtName + '":[\n')
-
-    alltext.append(vectorToJSON('location', bboxData.location, indent+2))
-    alltext.append(eulerToJSON('rotation_euler', bboxData.rotation_euler, indent+2))
-    alltext.append(vectorToJSON('location_from_cam', (bboxData.location) - cam.location , indent+2))
-
-    alltext.append(vectorToJSON('location_delta', bboxData.delta_location, indent+2))
-    alltext.append(eulerToJSON('rotation_euler_delta', bboxData.delta_rotation_euler, indent+2, compensate=False))
-    alltext.append(vectorToJSON('location_from_cam_delta', (bboxData.location + bboxData.delta_location) - cam.location , indent+2, comma=False))
+    obj = bpy.data.objects[trgtName]
+    record = TARGETS.get(trgtName)
+
+    data = {
+        "name": trgtName,
+        "bound": record.bound,
+        "id": record.id,
+        "location": vectorToList(bboxData.location),
+        "rotation_euler": eulerToDict(bboxData.rotation_euler),
+        "location_from_cam": vectorToList(bboxData.location - cam.location),
+        "location_delta": vectorToList(bboxData.delta_location),
+        "rotation_euler_delta": eulerToDict(bboxData.delta_rotation_euler, compensate=False),
+        "location_from_cam_delta": vectorToList((bboxData.location + bboxData.delta_location) - cam.location),
+        "dimensions": vectorToList(bboxData.dimensions),
+        "radius": jsonFloat(bboxData.radius),
+        "matrix_world": matrixToList(obj.matrix_world),
+    }
 
-    alltext.append(' ' * indent + ']}') 
+    if projection != None:
+        data["visible"] = projection.visible
+        data["bbox_2d"] = vectorToList(projection.bbox2d)
+        data["bbox_3d"] = matrixToList(projection.bbox3d)
+        data["sphere"] = vectorToList(projection.sphere)
 
-    return alltext
+    return data
 
 
 def extractAllBBoxData(addonData, trgtName, camName):
-    alltext = []
-
     cam = bpy.data.objects[camName]
 
+    trgtNames = [name for name in getDeployedTargetNames(bpy.context) if name.startswith(trgtName)]
+    projections = projectTargets(bpy.context.scene, cam, trgtNames)
 
-    trgtLineStart = '{"' + "targets" + '":[\n'
-    alltext.append(trgtLineStart)
-
-    for obj in bpy.context.scene.objects:
-        if obj.name.startswith(trgtName):
-            text = bboxDataToJSON(cam, obj.name, 4)
-            alltext = alltext + text
-            alltext.append(',\n')
-
-
-    trgtLineEnd = ']}'
-    alltext.append(trgtLineEnd)
-    return alltext
+    return [bboxDataToJSON(cam, name, projections[name]) for name in trgtNames]
 
 
 def extractBackgroundData(addonData,imgName):
-    alltext = []
-    
     img = bpy.data.objects[imgName]
 
-    alltext.append('{"' + 'background' + '":[\n')
-    
-    alltext.append(vectorToJSON('location', img.location, 2))
-    alltext.append(vectorToJSON('location_delta', img.delta_location, 2))
-    alltext.append(eulerToJSON('rotation_euler', img.rotation_euler,  2, compensate=False))
-    alltext.append(eulerToJSON('rotation_euler_delta', img.delta_rotation_euler,  2, compensate=False))
-
-    alltext.append(stringParamIntoJSON("background_file", addonData.background_file, comma=False))
-    alltext.append(']},\n')
-    return alltext
+    return {
+        "location": vectorToList(img.location),
+        "location_delta": vectorToList(img.delta_location),
+        "rotation_euler": eulerToDict(img.rotation_euler, compensate=False),
+        "rotation_euler_delta": eulerToDict(img.delta_rotation_euler, compensate=False),
+        "matrix_world": matrixToList(img.matrix_world),
+        "background_file": addonData.background_file,
+    }
 
 
 def extractCameraData(name):
     cam = bpy.data.objects[name]
-    alltext = []
-    alltext.append('{"' + 'camera' + '":[\n')
-    alltext.append(vectorToJSON('location', cam.location, 2))
-    alltext.append(vectorToJSON('location_delta', cam.delta_location, 2))
-    alltext.append(eulerToJSON('rotation_euler', cam.rotation_euler, 2, False))
-    alltext.append(eulerToJSON('rotation_euler_delta', cam.delta_rotation_euler, 2, False, compensate=False))
-    alltext.append(']},\n')
-    return alltext
-
-def extractPictureData(context, trgtName, camName, imgName, filename = "file"):
-    addonData = context.scene.addon_data
-
-    alltext = []
-    alltext = alltext + extractBackgroundData(addonData, imgName)
-    alltext = alltext + extractCameraData(camName)
-    alltext = alltext + extractAllBBoxData(addonData, trgtName, camName)
-
-    writeOutput(context, alltext, filename + '.txt')
-
+    K, width, height = getCameraIntrinsics(bpy.context.scene, cam)
+
+    return {
+        "location": vectorToList(cam.location),
+        "location_delta": vectorToList(cam.delta_location),
+        "rotation_euler": eulerToDict(cam.rotation_euler),
+        "rotation_euler_delta": eulerToDict(cam.delta_rotation_euler, compensate=False),
+        "matrix_world": matrixToList(cam.matrix_world),
+        "intrinsics": matrixToList(K),
+        "resolution": [width, height],
+    }
 
-def extractSceneConfigData(context, trgtName, camName, filename = "file"):
+def extractPictureData(context, trgtName, camName, imgName):
     addonData = context.scene.addon_data
+    bpy.context.scene.update()
 
-    alltext = []
-
-    alltext.append('{\n')
-    alltext.append(stringParamIntoJSON("data_path_out", addonData.data_path_out))
-    alltext.append(stringParamIntoJSON("data_path_objs", addonData.data_path_objs))
-    alltext.append(stringParamIntoJSON("data_path_bounds", addonData.data_path_bounds))
-    alltext.append(stringParamIntoJSON("data_path_imgs", addonData.data_path_imgs))
-    alltext.append(stringParamIntoJSON("filename_model_tag", addonData.filename_model_tag))
-    alltext.append(stringParamIntoJSON("filename_background_tag", addonData.filename_background_tag))
-
-    alltext.append(boolParamIntoJSON("is_format_obj", addonData.is_format_obj))
-    alltext.append(boolParamIntoJSON("is_format_stl", addonData.is_format_stl))
-    alltext.append(boolParamIntoJSON("is_format_ply", addonData.is_format_ply))
-    alltext.append(boolParamIntoJSON("is_format_3ds", addonData.is_format_3ds))
-
-    alltext.append(boolParamIntoJSON("is_shape_box", addonData.is_shape_box))
-    alltext.append(boolParamIntoJSON("is_shape_sphere", addonData.is_shape_sphere))
-
-    alltext.append(boolParamIntoJSON("is_random_number_of_models", addonData.is_random_number_of_models))
-    alltext.append(boolParamIntoJSON("is_randomize_the_use_of_models", addonData.is_randomize_the_use_of_models))
-    alltext.append(boolParamIntoJSON("is_randomize_the_use_of_images", addonData.is_randomize_the_use_of_images))
+    return {
+        "background": extractBackgroundData(addonData, imgName),
+        "camera": extractCameraData(camName),
+        "targets": extractAllBBoxData(addonData, trgtName, camName),
+    }
 
-    alltext.append(intParamIntoJSON("numOfModels", addonData.numOfModels))
-    alltext.append(intParamIntoJSON("max_number_of_models", addonData.max_number_of_models))
 
-    alltext.append(intParamIntoJSON("min_distance_from_camera", addonData.min_distance_from_camera))
-    alltext.append(intParamIntoJSON("max_distance_from_camera", addonData.max_distance_from_camera))
-    alltext.append(floatParamIntoJSON("field_of_view_coef", addonData.field_of_view_coef))
-    alltext.append(floatParamIntoJSON("proximity_coef", addonData.proximity_coef))
+# Only the properties that change the generated content are hashed, so the
+# shards and the resumed runs of one generation share their config: not the
+# output folder, the run range and the resume, the packaging of the output
+# and the settings that only change the speed or the memory use.
+CONFIG_EXCLUDED = ('rna_type', 'name', 'numOfModels', 'background_file',
+    'data_path_out', 'run_iterations', 'run_seed', 'is_resume',
+    'annotation_backend', 'annotation_shard_size', 'is_tar_output', 'tar_shard_size', 'is_tar_loose_deleted', 'png_compression',
+    'is_async_output', 'output_threads', 'output_queue_size', 'is_animation_render', 'is_persistent_data', 'is_persistent_rig',
+    'is_model_library_used', 'is_baked_library_used', 'is_background_pool_used', 'background_pool_size', 'background_pool_budget',
+    'is_background_cache_used', 'background_cache_margin', 'orphan_purge_interval', 'memory_limit', 'calibration_psnr')
 
-    alltext.append(boolParamIntoJSON("is_init_target_moving", addonData.is_init_target_moving))
-    alltext.append(floatParamIntoJSON("init_target_rotation_coef", addonData.init_target_rotation_coef))
-    alltext.append(floatParamIntoJSON("init_target_rot_constrain_x", addonData.init_target_rot_constrain_x))
-    alltext.append(floatParamIntoJSON("init_target_rot_constrain_y", addonData.init_target_rot_constrain_y))
-    alltext.append(floatParamIntoJSON("init_target_rot_constrain_z", addonData.init_target_rot_constrain_z))
+def extractSceneConfigData(context):
+    addonData = context.scene.addon_data
+    config = {}
+
+    for prop in addonData.bl_rna.properties:
+        if prop.identifier in CONFIG_EXCLUDED:
+            continue
+        value = getattr(addonData, prop.identifier)
+        config[prop.identifier] = value if isinstance(value, (bool, int, float, str)) else list(value)
+
+    return config
+
+def getConfigHash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+# The run config is written once and the samples reference it by its hash.
+def writeSceneConfig(context, folder=""):
+    config = extractSceneConfigData(context)
+    configHash = getConfigHash(config)
+    filename = folder + CONFIG_PREFIX + configHash + ".json"
+
+    if not os.path.isfile(os.path.join(context.scene.addon_data.data_path_out, filename)):
+        writeOutput(context, [json.dumps(config, indent=2, sort_keys=True)], filename)
+    return configHash
+
+
+# Sample manifest: one JSON record per line, appended when a sample is complete.
+class JsonLinesWriter:
+   def __init__(self, filepath):
+        self.filepath = filepath
+        self.fh = open(filepath, 'a')
+        # A record cut by a crash is closed, so the next one starts on its own line.
+        if self.fh.tell() > 0 and not self.endsWithNewline():
+            self.fh.write('\n')
+
+   def endsWithNewline(self):
+        with open(self.filepath, 'rb') as fh:
+            fh.seek(-1, os.SEEK_END)
+            return fh.read(1) == b'\n'
+
+   def write(self, record):
+        self.fh.write(json.dumps(record) + '\n')
+        self.fh.flush()
+
+   def close(self):
+        self.fh.close()
+
+def getManifestPath(context, folder=""):
+    return os.path.join(context.scene.addon_data.data_path_out, folder + MANIFEST_NAME)
+
+def appendManifestRecord(path, record):
+    writer = MANIFEST_WRITERS.get(path)
+    if writer == None:
+        writer = JsonLinesWriter(path)
+        MANIFEST_WRITERS[path] = writer
+    writer.write(record)
+
+def closeManifestWriters():
+    for writer in MANIFEST_WRITERS.values():
+        writer.close()
+    MANIFEST_WRITERS.clear()
+
+# On resume, the records of the samples that are generated again (e.g. their
+# NumPy shard was never written) are dropped and only the last record of a
+# name is kept, so every sample has one record. The file is rewritten under a
+# temporary name.
+def filterJsonLines(path, names):
+    records = collections.OrderedDict()
+    try:
+        with open(path, 'r') as fh:
+            for line in fh:
+                try:
+                    name = json.loads(line).get("name")
+                except (ValueError, AttributeError):
+                    continue
+                if name in names:
+                    records.pop(name, None)
+                    records[name] = line if line.endswith('\n') else line + '\n'
+    except (IOError, OSError):
+        return
+    with open(path + ".tmp", 'w') as fh:
+        fh.writelines(records.values())
+    os.replace(path + ".tmp", path)
+
+def filterResumedRecords(context, folder, names):
+    directory = context.scene.addon_data.data_path_out
+    for filename in (MANIFEST_NAME, METRICS_NAME, TAR_INDEX_NAME):
+        filterJsonLines(os.path.join(directory, folder + filename), names)
+
+# A run that does not resume starts new records. The NumPy and tar shards are
+# removed with them, the sample files are overwritten.
+def resetRunRecords(context, folder=""):
+    filterResumedRecords(context, folder, set())
+    directory = getAnnotationDirectory(context, folder)
+    for path in getAnnotationShardPaths(directory):
+        os.remove(path)
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if name.startswith(TAR_PREFIX) and name.endswith(".tar"):
+            os.remove(os.path.join(directory, name))
+
+def readManifestNames(context, folder=""):
+    names = set()
+    try:
+        with open(getManifestPath(context, folder), 'r') as fh:
+            for line in fh:
+                try:
+                    names.add(json.loads(line)["name"])
+                except (ValueError, KeyError):
+                    pass
+    except (IOError, OSError):
+        pass
+    return names
 
-    alltext.append(boolParamIntoJSON("is_target_moving", addonData.is_target_moving))
-    alltext.append(floatParamIntoJSON("target_move_coef", addonData.target_move_coef))
-    alltext.append(floatParamIntoJSON("target_rotation_coef", addonData.target_rotation_coef))
-    alltext.append(floatParamIntoJSON("target_move_constrain_x", addonData.target_move_constrain_x))
-    alltext.append(floatParamIntoJSON("target_move_constrain_y", addonData.target_move_constrain_y))
-    alltext.append(floatParamIntoJSON("target_move_constrain_z", addonData.target_move_constrain_z))
 
-    alltext.append(boolParamIntoJSON("is_background_moving", addonData.is_background_moving))
-    alltext.append(floatParamIntoJSON("background_move_coef", addonData.background_move_coef))
-    alltext.append(floatParamIntoJSON("background_rotation_coef", addonData.background_rotation_coef))
-    alltext.append(floatParamIntoJSON("background_move_constrain_x", addonData.background_move_constrain_x))
-    alltext.append(floatParamIntoJSON("background_move_constrain_y", addonData.background_move_constrain_y))
-    alltext.append(floatParamIntoJSON("background_move_constrain_z", addonData.background_move_constrain_z))
+#############################
+# NUMPY ANNOTATION SHARDS
+
+# Columnar form of the sample records: one row per sample (camera and
+# background of both frames) and one row per target and frame. The targets
+# reference their sample by its index, so the shards can be concatenated.
+# The string fields are as wide as the longest value of a shard, the widths
+# below are the minimum.
+SAMPLE_DTYPE = np.dtype([
+    ('index', np.int64),
+    ('name', 'U1'),
+    ('seed', np.int64),
+    ('config', 'U16'),
+    ('num_of_models', np.int32),
+    ('background_file', 'U1'),
+    ('resolution', np.int32, (2,)),
+    ('camera_intrinsics', np.float64, (2, 3, 3)),
+    ('camera_matrix_world', np.float64, (2, 4, 4)),
+    ('camera_location', np.float64, (2, 3)),
+    ('camera_location_delta', np.float64, (2, 3)),
+    ('camera_rotation_euler', np.float64, (2, 3)),
+    ('camera_rotation_euler_delta', np.float64, (2, 3)),
+    ('background_matrix_world', np.float64, (2, 4, 4)),
+    ('background_location', np.float64, (2, 3)),
+    ('background_location_delta', np.float64, (2, 3)),
+    ('background_rotation_euler', np.float64, (2, 3)),
+    ('background_rotation_euler_delta', np.float64, (2, 3)),
+])
+
+TARGET_DTYPE = np.dtype([
+    ('sample', np.int64),
+    ('frame', np.int8),
+    ('name', 'U1'),
+    ('bound', 'U3'),
+    ('id', np.int64),
+    ('matrix_world', np.float64, (4, 4)),
+    ('location', np.float64, (3,)),
+    ('location_delta', np.float64, (3,)),
+    ('location_from_cam', np.float64, (3,)),
+    ('location_from_cam_delta', np.float64, (3,)),
+    ('rotation_euler', np.float64, (3,)),
+    ('rotation_euler_delta', np.float64, (3,)),
+    ('dimensions', np.float64, (3,)),
+    ('radius', np.float64),
+    ('visible', np.bool_),
+    ('bbox_2d', np.float64, (4,)),
+    ('bbox_3d', np.float64, (8, 2)),
+    ('sphere', np.float64, (3,)),
+])
+
+SAMPLE_OBJECTS = ('camera', 'background')
+SAMPLE_FIELDS = ('matrix_world', 'location', 'location_delta', 'rotation_euler', 'rotation_euler_delta')
+SAMPLE_STRINGS = ('name', 'config', 'background_file')
+TARGET_STRINGS = ('name', 'bound')
+TARGET_FIELDS = ('matrix_world', 'location', 'location_delta', 'location_from_cam', 'location_from_cam_delta', 'rotation_euler', 'rotation_euler_delta', 'dimensions', 'radius', 'bbox_2d', 'bbox_3d', 'sphere')
+
+# The null values of the records (non-finite numbers) become NaN again.
+def toFloatArray(value):
+    if isinstance(value, dict):
+        value = value["value"]
+    return np.array(value, dtype=np.float64)
+
+def getSizedDtype(dtype, widths):
+    descr = []
+    for field in dtype.descr:
+        if field[0] in widths:
+            width = max(widths[field[0]], dtype.fields[field[0]][0].itemsize // 4)
+            field = (field[0], '<U' + str(width)) + tuple(field[2:])
+        descr.append(field)
+    return np.dtype(descr)
+
+def getStringWidths(rows, fields):
+    return dict([(field, max([len(row[field]) for row in rows] + [1])) for field in fields])
+
+def getSampleDtype(records):
+    rows = [{"name": record["name"], "config": record["config"], "background_file": record["frames"][0]["background"]["background_file"]} for record in records]
+    return getSizedDtype(SAMPLE_DTYPE, getStringWidths(rows, SAMPLE_STRINGS))
+
+def getTargetDtype(records):
+    rows = [target for record in records for frame in record["frames"] for target in frame["targets"]]
+    return getSizedDtype(TARGET_DTYPE, getStringWidths(rows, TARGET_STRINGS))
+
+# The arrays of several shards are widened to their widest string fields.
+def concatenateShards(arrays, dtype, strings):
+    widths = dict([(field, max([array.dtype.fields[field][0].itemsize // 4 for array in arrays])) for field in strings])
+    dtype = getSizedDtype(dtype, widths)
+    return np.concatenate([array.astype(dtype) for array in arrays])
+
+def recordToSampleRow(record, dtype=SAMPLE_DTYPE):
+    row = np.zeros(1, dtype=dtype)[0]
+    frames = record["frames"]
+    row['index'] = record["index"]
+    row['name'] = record["name"]
+    row['seed'] = record["seed"]
+    row['config'] = record["config"]
+    row['num_of_models'] = record["num_of_models"]
+    row['background_file'] = frames[0]["background"]["background_file"]
+    row['resolution'] = frames[0]["camera"]["resolution"]
+
+    for f, frame in enumerate(frames):
+        row['camera_intrinsics'][f] = toFloatArray(frame["camera"]["intrinsics"])
+        for obj in SAMPLE_OBJECTS:
+            for field in SAMPLE_FIELDS:
+                row[obj + '_' + field][f] = toFloatArray(frame[obj][field])
+    return row
+
+def recordToTargetRows(record, dtype=TARGET_DTYPE):
+    rows = []
+    for f, frame in enumerate(record["frames"]):
+        for target in frame["targets"]:
+            row = np.zeros(1, dtype=dtype)[0]
+            row['sample'] = record["index"]
+            row['frame'] = f + 1
+            row['name'] = target["name"]
+            row['bound'] = target["bound"]
+            row['id'] = target["id"]
+            row['visible'] = target.get("visible", False)
+            for field in TARGET_FIELDS:
+                if field in target:
+                    row[field] = toFloatArray(target[field])
+                else:
+                    row[field] = np.nan
+            rows.append(row)
+    return rows
+
+
+# Collects the rows of the samples and writes them as one shard per
+# 'size' samples. A shard is named after the index of its first sample, so
+# the shards of parallel or resumed runs never collide.
+class AnnotationShardWriter:
+   def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.records = []
+
+   def add(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.size:
+            self.flush()
+
+   def flush(self):
+        if len(self.records) == 0:
+            return
+        sampleDtype = getSampleDtype(self.records)
+        targetDtype = getTargetDtype(self.records)
+        samples = np.array([recordToSampleRow(record, sampleDtype) for record in self.records], dtype=sampleDtype)
+        targets = np.array([row for record in self.records for row in recordToTargetRows(record, targetDtype)], dtype=targetDtype)
+        path = os.path.join(self.directory, ANNOTATION_PREFIX + "{:09d}".format(int(samples['index'][0])) + ".npz")
+
+        # Written under a temporary name, so a shard on disk is always complete.
+        with open(path + ".tmp", 'wb') as fh:
+            np.savez_compressed(fh, samples=samples, targets=targets)
+        os.replace(path + ".tmp", path)
+
+        self.records = []
+
+def isAnnotationBackend(addonData, backend):
+    return addonData.annotation_backend in (backend, 'BOTH')
+
+def getAnnotationDirectory(context, folder=""):
+    return os.path.join(context.scene.addon_data.data_path_out, folder)
+
+def addAnnotationRecord(settings, record):
+    writer = ANNOTATION_WRITERS.get(settings.directory)
+    if writer == None:
+        writer = AnnotationShardWriter(settings.directory, settings.annotationShardSize)
+        ANNOTATION_WRITERS[settings.directory] = writer
+    writer.add(record)
+
+def closeAnnotationWriters():
+    for writer in ANNOTATION_WRITERS.values():
+        writer.flush()
+    ANNOTATION_WRITERS.clear()
+
+def getAnnotationShardPaths(directory):
+    try:
+        names = sorted(os.listdir(directory))
+    except (IOError, OSError):
+        return []
+    return [os.path.join(directory, name) for name in names if name.startswith(ANNOTATION_PREFIX) and name.endswith(".npz")]
+
+def readAnnotationShardNames(context, folder=""):
+    names = set()
+    for path in getAnnotationShardPaths(getAnnotationDirectory(context, folder)):
+        with np.load(path) as shard:
+            names.update(shard['samples']['name'].tolist())
+    return names
+
+# Reads every shard of a directory into one samples and one targets array.
+def loadAnnotationShards(directory):
+    samples = []
+    targets = []
+    for path in getAnnotationShardPaths(directory):
+        with np.load(path) as shard:
+            samples.append(shard['samples'])
+            targets.append(shard['targets'])
+    if len(samples) == 0:
+        return np.zeros(0, dtype=SAMPLE_DTYPE), np.zeros(0, dtype=TARGET_DTYPE)
+    return concatenateShards(samples, SAMPLE_DTYPE, SAMPLE_STRINGS), concatenateShards(targets, TARGET_DTYPE, TARGET_STRINGS)
 
-    alltext.append(boolParamIntoJSON("is_camera_moving", addonData.is_camera_moving))
-    alltext.append(floatParamIntoJSON("camera_move_coef", addonData.camera_move_coef))
-    alltext.append(floatParamIntoJSON("camera_rotation_coef", addonData.camera_rotation_coef))
-    alltext.append(floatParamIntoJSON("camera_move_constrain_x", addonData.camera_move_constrain_x))
-    alltext.append(floatParamIntoJSON("camera_move_constrain_y", addonData.camera_move_constrain_y))
-    alltext.append(floatParamIntoJSON("camera_move_constrain_z", addonData.camera_move_constrain_z, comma=False))
+#############################
+# TAR SHARDS
+
+# The samples are streamed into tar shards of about 'size' bytes: the files of
+# a sample, then its record as <name>.json, so the members of a sample are
+# adjacent (webdataset layout). The offset and size of every member are
+# appended to the shard index, so a single file can be read without a scan.
+class TarShardWriter:
+   def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.tar = None
+        self.filename = None
+        self.index = JsonLinesWriter(os.path.join(directory, TAR_INDEX_NAME))
+
+   def open(self, firstIndex):
+        self.filename = TAR_PREFIX + "{:09d}".format(firstIndex) + ".tar"
+        self.tar = tarfile.open(os.path.join(self.directory, self.filename), 'w', format=tarfile.GNU_FORMAT)
+
+   def addMember(self, tarinfo, fileobj, members):
+        offset = self.tar.offset + len(tarinfo.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(tarinfo, fileobj)
+        members[tarinfo.name] = {"offset": offset, "size": tarinfo.size}
+
+   def add(self, record, filenames):
+        if self.tar != None and self.tar.offset >= self.size:
+            self.close()
+        if self.tar == None:
+            self.open(record["index"])
+
+        members = {}
+        for filename in filenames:
+            tarinfo = self.tar.gettarinfo(os.path.join(self.directory, filename), arcname=filename)
+            with open(os.path.join(self.directory, filename), 'rb') as fh:
+                self.addMember(tarinfo, fh, members)
+
+        data = json.dumps(record).encode('utf-8')
+        tarinfo = tarfile.TarInfo(record["name"] + ".json")
+        tarinfo.size = len(data)
+        tarinfo.mtime = os.path.getmtime(os.path.join(self.directory, filenames[0])) if len(filenames) > 0 else 0
+        self.addMember(tarinfo, io.BytesIO(data), members)
+
+        # The members of a sample are on disk before it is indexed.
+        self.tar.fileobj.flush()
+        self.index.write({"name": record["name"], "shard": self.filename, "members": members})
+
+   def close(self):
+        if self.tar != None:
+            self.tar.close()
+        self.tar = None
+
+def getSampleFilesOnDisk(directory, record):
+    return [filename for filename in sorted(record["files"].values()) if os.path.isfile(os.path.join(directory, filename))]
+
+def addTarSample(settings, record):
+    writer = TAR_WRITERS.get(settings.directory)
+    if writer == None:
+        writer = TarShardWriter(settings.directory, settings.tarShardSize)
+        TAR_WRITERS[settings.directory] = writer
+
+    filenames = getSampleFilesOnDisk(settings.directory, record)
+    writer.add(record, filenames)
+
+    if settings.isLooseDeleted:
+        for filename in filenames:
+            os.remove(os.path.join(settings.directory, filename))
+
+def closeTarWriters():
+    for writer in TAR_WRITERS.values():
+        writer.close()
+        writer.index.close()
+    TAR_WRITERS.clear()
+
+
+# The settings of the record writers are read from the scene up front, so the
+# records can be written by the writer threads without touching bpy.
+class OutputSettings:
+   def __init__(self, context, folder=""):
+        addonData = context.scene.addon_data
+        self.directory = getAnnotationDirectory(context, folder)
+        self.manifestPath = getManifestPath(context, folder)
+        self.isJsonl = isAnnotationBackend(addonData, 'JSONL')
+        self.isNpz = isAnnotationBackend(addonData, 'NPZ')
+        self.annotationShardSize = addonData.annotation_shard_size
+        self.isTar = addonData.is_tar_output
+        self.tarShardSize = addonData.tar_shard_size * 1024 * 1024
+        self.isLooseDeleted = addonData.is_tar_loose_deleted
+
+# The manifest record is appended last in every case, it marks the sample
+# as complete. With the NumPy shards only, it does not repeat the frames.
+def writeSampleRecord(settings, record):
+    if settings.isNpz:
+        addAnnotationRecord(settings, record)
+    if settings.isTar:
+        addTarSample(settings, record)
+    if not settings.isJsonl:
+        record = dict((key, value) for key, value in record.items() if key != "frames")
+    appendManifestRecord(settings.manifestPath, record)
 
-    alltext.append('}\n')
 
-    writeOutput(context, alltext, filename + '.txt')
+#############################
+# IMAGE ENCODING
+
+# The captured pixels are linear, the color management of the scene ('Default'
+# view transform: sRGB, exposure and gamma) is applied before the 8/16 bit formats.
+class ImageOutput:
+   def __init__(self, context):
+        scene = context.scene
+        addonData = scene.addon_data
+        self.format = getOutputFormat(scene)
+        self.depth = getOutputDepth(scene)
+        self.compression = addonData.png_compression
+        if addonData.image_format == 'SCENE':
+            self.compression = int(round(scene.render.image_settings.compression * 9 / 100.0))
+        self.channels = 4 if scene.render.image_settings.color_mode == 'RGBA' else 3
+        self.isSRGB = scene.view_settings.view_transform not in ('Raw', 'Non-Color')
+        self.exposure = scene.view_settings.exposure
+        self.gamma = scene.view_settings.gamma
+
+def isWebPAvailable():
+    if 'webp' not in WEBP_SUPPORT:
+        try:
+            from PIL import features
+            WEBP_SUPPORT['webp'] = features.check('webp')
+        except ImportError:
+            WEBP_SUPPORT['webp'] = False
+    return WEBP_SUPPORT['webp']
+
+SCENE_FORMATS = {'PNG': 'PNG', 'OPEN_EXR': 'EXR'}
+
+# The format encoded by the background writer, None when only Blender can
+# write the format of the scene.
+def getOutputFormat(scene):
+    addonData = scene.addon_data
+    if addonData.image_format == 'SCENE':
+        return SCENE_FORMATS.get(scene.render.image_settings.file_format)
+    if addonData.image_format == 'WEBP' and not isWebPAvailable():
+        return 'PNG'
+    return addonData.image_format
+
+def getOutputDepth(scene):
+    if scene.addon_data.image_format == 'SCENE':
+        return int(scene.render.image_settings.color_depth)
+    return int(scene.addon_data.image_color_depth)
+
+# Only the plain views are encoded like Blender writes them: 'Default' (sRGB)
+# or 'Raw', without a look or curves, and without dither for 8 bit. EXR is
+# written linear, the view doesn't apply.
+DISPLAY_VIEWS = ('Default', 'Raw', 'Non-Color')
+
+def isViewEncoded(scene):
+    outputFormat = getOutputFormat(scene)
+    if outputFormat == 'EXR':
+        return True
+    view = scene.view_settings
+    if outputFormat == None or view.view_transform not in DISPLAY_VIEWS or view.look != 'None' or view.use_curve_mapping:
+        return False
+    return scene.render.dither_intensity == 0 or (outputFormat == 'PNG' and getOutputDepth(scene) > 8)
+
+def getImageExtension(addonData):
+    if addonData.image_format == 'SCENE':
+        return bpy.context.scene.render.file_extension
+    if addonData.image_format == 'EXR':
+        return ".exr"
+    if addonData.image_format == 'WEBP' and isImageCaptured(addonData) and isWebPAvailable():
+        return ".webp"
+    return ".png"
+
+def linearToSRGB(rgb):
+    rgb = np.maximum(rgb, 0)
+    return np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.power(rgb, 1 / 2.4) - 0.055)
+
+def toDisplay(pixels, output):
+    rgb = pixels[:, :, :3] * (2 ** output.exposure)
+    if output.isSRGB:
+        rgb = linearToSRGB(rgb)
+    if output.gamma != 1:
+        rgb = np.power(np.maximum(rgb, 0), 1 / output.gamma)
+    return np.clip(np.concatenate((rgb, pixels[:, :, 3:output.channels]), axis=2), 0, 1)
+
+def pngChunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+# Every row is stored with the 'Up' filter (difference to the row above).
+def writePNG(filepath, pixels, depth, compression):
+    height, width, channels = pixels.shape
+    if depth == 16:
+        raw = np.rint(pixels * 65535).astype('>u2')
+    else:
+        raw = np.rint(pixels * 255).astype(np.uint8)
+    raw = raw.view(np.uint8).reshape(height, -1)
+
+    rows = np.empty((height, raw.shape[1] + 1), dtype=np.uint8)
+    rows[:, 0] = 2
+    rows[:, 1:] = raw
+    rows[1:, 1:] -= raw[:-1]
+
+    header = struct.pack('>IIBBBBB', width, height, depth, 6 if channels == 4 else 2, 0, 0, 0)
+    with open(filepath, 'wb') as fh:
+        fh.write(b'\x89PNG\r\n\x1a\n')
+        fh.write(pngChunk(b'IHDR', header))
+        fh.write(pngChunk(b'IDAT', zlib.compress(rows.tobytes(), compression)))
+        fh.write(pngChunk(b'IEND', b''))
+
+def exrAttribute(name, type, data):
+    return name.encode('ascii') + b'\0' + type.encode('ascii') + b'\0' + struct.pack('<i', len(data)) + data
+
+# Uncompressed scanline OpenEXR: header, line offset table, then every line as
+# y, size and the channels one after the other in alphabetical order.
+def writeEXR(filepath, pixels, depth):
+    height, width, count = pixels.shape
+    names = 'RGBA'[:count]
+    order = sorted(range(count), key=lambda c: names[c])
+    dtype = np.dtype('<f4' if depth == 32 else '<f2')
+
+    channels = b''
+    for c in order:
+        channels += names[c].encode('ascii') + b'\0' + struct.pack('<iB3xii', 2 if depth == 32 else 1, 0, 1, 1)
+    window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+
+    header = struct.pack('<ii', 20000630, 2)
+    header += exrAttribute('channels', 'chlist', channels + b'\0')
+    header += exrAttribute('compression', 'compression', b'\0')
+    header += exrAttribute('dataWindow', 'box2i', window)
+    header += exrAttribute('displayWindow', 'box2i', window)
+    header += exrAttribute('lineOrder', 'lineOrder', b'\0')
+    header += exrAttribute('pixelAspectRatio', 'float', struct.pack('<f', 1.0))
+    header += exrAttribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0.0, 0.0))
+    header += exrAttribute('screenWindowWidth', 'float', struct.pack('<f', 1.0))
+    header += b'\0'
+
+    lineSize = width * count * dtype.itemsize
+    lines = np.empty((height, 8 + lineSize), dtype=np.uint8)
+    lines[:, :8] = np.stack((np.arange(height), np.full(height, lineSize)), axis=1).astype('<i4').view(np.uint8)
+    lines[:, 8:] = pixels[:, :, order].astype(dtype).transpose(0, 2, 1).reshape(height, -1).view(np.uint8)
+    offsets = len(header) + 8 * height + np.arange(height, dtype=np.uint64) * (8 + lineSize)
+
+    with open(filepath, 'wb') as fh:
+        fh.write(header)
+        fh.write(offsets.astype('<u8').tobytes())
+        fh.write(lines.tobytes())
+
+def writeWebP(filepath, pixels):
+    from PIL import Image
+    Image.fromarray(np.rint(pixels * 255).astype(np.uint8)).save(filepath, 'WEBP', lossless=True)
+
+def writeImage(filepath, pixels, output):
+    if output.format == 'EXR':
+        writeEXR(filepath, pixels[:, :, :output.channels], 16 if output.depth == 8 else output.depth)
+    elif output.format == 'WEBP':
+        writeWebP(filepath, toDisplay(pixels, output))
+    else:
+        writePNG(filepath, toDisplay(pixels, output), 16 if output.depth > 8 else 8, output.compression)
 
 
+#############################
+# OUTPUT POOL
+
+# The outputs of a sample are encoded and written by the writer threads. The
+# record of a sample is written after every output of the sample and after the
+# record of the previous sample, so the records stay complete and in order.
+# When the queue is full, submit waits for a free slot.
+class OutputPool:
+   def __init__(self, threads, queueSize):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(queueSize)
+        self.pending = []
+        self.last = None
+        self.errors = []
+
+   def run(self, fn, args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            self.errors.append(e)
+            raise
+        finally:
+            self.slots.release()
+
+   def checkErrors(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+   def submit(self, fn, *args):
+        self.checkErrors()
+        self.slots.acquire()
+        self.pending.append(self.executor.submit(self.run, fn, args))
+
+   def after(self, previous, outputs, fn, args):
+        if previous != None:
+            concurrent.futures.wait([previous])
+        for future in outputs:
+            future.result()
+        return fn(*args)
+
+   def finish(self, fn, *args):
+        self.checkErrors()
+        self.slots.acquire()
+        self.last = self.executor.submit(self.run, self.after, (self.last, self.pending, fn, args))
+        self.pending = []
+
+   def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.checkErrors()
+
+def openOutputPool(context):
+    global OUTPUT_POOL
+    addonData = context.scene.addon_data
+    if addonData.is_async_output:
+        OUTPUT_POOL = OutputPool(addonData.output_threads, addonData.output_queue_size)
+        if not addonData.is_flow_output and not isViewEncoded(context.scene):
+            print("\nBackground writer: the format or the view of the scene (view transform, look, curves, dither) is not encoded by the writer, the images are written by Blender.")
+
+def closeOutputPool():
+    global OUTPUT_POOL
+    pool = OUTPUT_POOL
+    OUTPUT_POOL = None
+    if pool != None:
+        pool.shutdown()
+
+def submitOutput(fn, *args):
+    if OUTPUT_POOL == None:
+        fn(*args)
+    else:
+        OUTPUT_POOL.submit(fn, *args)
 
+def finishSample(fn, *args):
+    if OUTPUT_POOL == None:
+        fn(*args)
+    else:
+        OUTPUT_POOL.finish(fn, *args)
 
 
  
@@ -483,15 +1489,14 @@ def moveRandomly(trgtName, linerCoef, rotationalCoef, xC=1, yC=1, zC=1 ):
     trgt.delta_location = dLoc
     dRotEuler = (radians(randomNum(rotationalCoef)), radians(randomNum(rotationalCoef)), radians(randomNum(rotationalCoef)))    
     trgt.delta_rotation_euler = dRotEuler
-    print("     ->    ", dRotEuler)
 
 
 def moveAllTargetsRandomly(context, trgtName):  
     addonData = context.scene.addon_data 
     if addonData.is_target_moving == True: 
-        for obj in bpy.context.scene.objects:
-            if obj.name.startswith(trgtName):
-                moveRandomly(obj.name, addonData.target_move_coef, addonData.target_rotation_coef, addonData.target_move_constrain_x,addonData.target_move_constrain_y,addonData.target_move_constrain_z )
+        for name in getDeployedTargetNames(context):
+            if name.startswith(trgtName):
+                moveRandomly(name, addonData.target_move_coef, addonData.target_rotation_coef, addonData.target_move_constrain_x,addonData.target_move_constrain_y,addonData.target_move_constrain_z )
 
 
 def randomRotateObject(name, coef, xR=1, yR=1, zR=1): 
@@ -513,6 +1518,16 @@ def moveCameraRandomly(context, name):
 def resetRandomMove( name):
     moveRandomly(name, 0, 0)
 
+def resetDeltas(obj):
+    obj.delta_location = (0, 0, 0)
+    obj.delta_rotation_euler = (0, 0, 0)
+
+def resetTransform(obj, location, rotationEuler):
+    obj.rotation_mode = 'XYZ'
+    obj.location = location
+    obj.rotation_euler = rotationEuler
+    resetDeltas(obj)
+
 def moveAllAsConfigSays(context):
     moveAllTargetsRandomly(context, TARGET_NAME)
     moveCameraRandomly(context, CAM_NAME)
@@ -551,7 +1566,7 @@ def addCamera(context, camName, location, rotationEuler):
     cam_obj.rotation_euler = rotationEuler
     bpy.context.scene.objects.link(cam_obj)
     bpy.context.scene.update()
-    TARGET_OBJECTS.append(DeployedObjData(camName, cam_obj.location, 2))
+    TARGETS.addObstacle(camName, cam_obj.location, 2)
     bpy.data.scenes["Scene"].camera = cam_obj
 
 
@@ -575,40 +1590,106 @@ def createRandomSeedPosition(context, camName, distance, twitchMax = 1):
     return location, rotation_q
 
 
-def getSeedPosition(context, camName, addonData, bboxData, positionList, proximityC): 
-
-    seedPos = None  
-    seedRot = None
+# Placement: the candidates are sampled in batches inside the camera frustum
+# (between the min and max distance) and tested against every deployed object
+# at once. If no random batch has a free position, a grid covering the whole
+# frustum is searched, then grids of half the step around its near misses
+# (the candidates with the least overlap). A position is found whenever the
+# finest grid has one: gaps smaller than its step can still be missed.
+PLACEMENT_BATCH = 256
+PLACEMENT_BATCHES = 4
+PLACEMENT_GRID_MAX = 48
+PLACEMENT_CHUNK = 16384
+PLACEMENT_REFINEMENTS = 4
+PLACEMENT_REFINE_POINTS = 64
+
+class CameraFrame:
+   def __init__(self, context, cam):
+        vx, vy, vz, z_distance, y_max, x_max, loc, rot_quat = cameraData(context, cam, 1)
+        self.location = np.array(loc)
+        self.vx = np.array(vx)
+        self.vy = np.array(vy)
+        self.vz = np.array(vz)
+        self.x_max = x_max.length
+        self.y_max = y_max.length
+        self.rotation = rot_quat
+
+def frustumPositions(frame, dist, rx, ry):
+    return (frame.location
+        - np.outer(dist, frame.vz)
+        - np.outer(dist * frame.x_max * rx, frame.vx)
+        - np.outer(dist * frame.y_max * ry, frame.vy))
+
+# Distance to the closest deployed object, less the radii. Negative: overlap.
+def getClearance(candidates, radius, centers, radii, proximityC):
+    if len(centers) == 0:
+        return np.full(len(candidates), np.inf)
+    dist = np.linalg.norm(candidates[:, None, :] - centers[None, :, :], axis=2)
+    return np.min(dist - radius*proximityC - radii*proximityC, axis=1)
+
+def getFreePositions(candidates, radius, centers, radii, proximityC):
+    return getClearance(candidates, radius, centers, radii, proximityC) >= 0
+
+def getPlacementGrid(frame, minDist, maxDist, step):
+    nd = int(min(PLACEMENT_GRID_MAX, max(2, math.ceil((maxDist - minDist) / step) + 1)))
+    nx = int(min(PLACEMENT_GRID_MAX, max(2, math.ceil(2 * maxDist * frame.x_max / step) + 1)))
+    ny = int(min(PLACEMENT_GRID_MAX, max(2, math.ceil(2 * maxDist * frame.y_max / step) + 1)))
+    dist, rx, ry = np.meshgrid(np.linspace(minDist, maxDist, nd), np.linspace(-1, 1, nx), np.linspace(-1, 1, ny), indexing='ij')
+    steps = np.array([(maxDist - minDist) / float(nd - 1), 2.0 / (nx - 1), 2.0 / (ny - 1)])
+    return dist.ravel(), rx.ravel(), ry.ravel(), steps
+
+# Returns the first free position (in random order) and the clearance of every point.
+def searchPlacementGrid(frame, dist, rx, ry, rng, radius, centers, radii, proximityC):
+    order = rng.permutation(len(dist))
+    clearance = np.full(len(dist), -np.inf)
+    for first in range(0, len(order), PLACEMENT_CHUNK):
+        countStage('placement_batches')
+        chunk = order[first:first + PLACEMENT_CHUNK]
+        candidates = frustumPositions(frame, dist[chunk], rx[chunk], ry[chunk])
+        clearance[chunk] = getClearance(candidates, radius, centers, radii, proximityC)
+
+        free = np.flatnonzero(clearance[chunk] >= 0)
+        if len(free) > 0:
+            return mathutils.Vector(candidates[free[0]]), clearance
+    return None, clearance
+
+# The points around the near misses, at the given (halved) step.
+def refinePlacementGrid(dist, rx, ry, clearance, steps, minDist, maxDist):
+    best = np.argsort(-clearance)[:PLACEMENT_REFINE_POINTS]
+    offsets = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.float64) * steps
+    points = (np.stack((dist[best], rx[best], ry[best]), axis=1)[:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+    points = np.clip(points, [minDist, -1, -1], [maxDist, 1, 1])
+    return points[:, 0], points[:, 1], points[:, 2]
+
+def getSeedPosition(context, camName, addonData, radius, registry, proximityC): 
+    rng = np.random.RandomState(random.randint(0, 2**32 - 1))
+    frame = CameraFrame(context, bpy.context.scene.objects[camName])
 
-    i_findPos = 100
     minDist = addonData.min_distance_from_camera
     maxDist = addonData.max_distance_from_camera
-    overlap = -1
 
-    while i_findPos > 0 :
+    centers, radii = registry.getPlacementArrays()
 
-        isOverlaped = False
-        overlap = -1
-        dist = ((maxDist - minDist) * random.random()) + minDist
-        seedPos, seedRot = createRandomSeedPosition(context, camName, dist, 1)
-        i_findPos = i_findPos-1  
+    for i in range(PLACEMENT_BATCHES):
+        countStage('placement_batches')
+        dist = rng.uniform(minDist, maxDist, PLACEMENT_BATCH)
+        rx = rng.uniform(-1, 1, PLACEMENT_BATCH)
+        ry = rng.uniform(-1, 1, PLACEMENT_BATCH)
+        candidates = frustumPositions(frame, dist, rx, ry)
 
-        for pos in positionList:
-            delta = seedPos - pos.location
-            overlap = delta.length - bboxData.radius*proximityC - pos.radius*proximityC
+        free = np.flatnonzero(getFreePositions(candidates, radius, centers, radii, proximityC))
+        if len(free) > 0:
+            return mathutils.Vector(candidates[free[0]]), frame.rotation
 
-            if 0 > overlap :
-                isOverlaped = True
-                break
+    dist, rx, ry, steps = getPlacementGrid(frame, minDist, maxDist, max(radius*proximityC, 0.1))
+    for level in range(PLACEMENT_REFINEMENTS + 1):
+        position, clearance = searchPlacementGrid(frame, dist, rx, ry, rng, radius, centers, radii, proximityC)
+        if position != None:
+            return position, frame.rotation
+        steps = steps / 2.0
+        dist, rx, ry = refinePlacementGrid(dist, rx, ry, clearance, steps, minDist, maxDist)
 
-        if isOverlaped==False :
-            break
-        else:
-            seedPos = None  
-            seedRot = None
-
-
-    return seedPos, seedRot
+    return None, None
 
 
 def getBackgroundPosition():
@@ -632,20 +1713,447 @@ def resizeImage(imgname, distFromCam):
 
 
 #############################
-# Add/remove objects 
+# Model library 
+
+# The imported, joined and origin centered models are kept out of the scene,
+# the targets are linked duplicates sharing their mesh.
+def getLibraryModel(filePath):
+    name = MODEL_LIBRARY.get(filePath)
+    if name != None and name in bpy.data.objects:
+        MODEL_LIBRARY_STATS['hits'] += 1
+        return bpy.data.objects[name]
+
+    MODEL_LIBRARY_STATS['misses'] += 1
+    obj = loadBakedModel(bpy.context, filePath)
+    if obj != None:
+        MODEL_LIBRARY_STATS['baked'] += 1
+    else:
+        obj = importModel(filePath)
+        if obj == None:
+            return None
+        bpy.context.scene.objects.unlink(obj)
+
+    obj.name = LIB_NAME + '.' + os.path.basename(filePath)
+    obj.use_fake_user = True
+    MODEL_LIBRARY[filePath] = obj.name
+    return obj
+
+# The radius baked into the template, or the one of its dimensions.
+def getTemplateRadius(template):
+    if 'ofigen_radius' in template:
+        return template['ofigen_radius']
+    return getBoundingRadius(template.dimensions)
+
+# The mesh and materials of a template made by an earlier run are no longer
+# kept by the purges (see keepSceneData).
+def releaseLibraryData(obj):
+    if obj.type != 'MESH' or len(RUN_DATA_POINTERS) == 0:
+        return
+    RUN_DATA_POINTERS['meshes'].discard(obj.data.as_pointer())
+    for material in obj.data.materials:
+        if material != None:
+            RUN_DATA_POINTERS['materials'].discard(material.as_pointer())
 
-def getUniqueID():
-    id = 0
-    while True:
-        # newID = random.randint(10000000, 99999999)   
-        newID = IDS[-1] + 1
-        if ~(newID in IDS):
-            id = newID
-            IDS.append(newID)
-            break
-    return id
+def removeLibraryObject(name):
+    obj = bpy.data.objects.get(name)
+    if obj != None:
+        releaseLibraryData(obj)
+        obj.use_fake_user = False
+        bpy.data.objects.remove(obj)
+
+def clearModelLibrary():
+    for name in LOD_LIBRARY.values():
+        removeLibraryObject(name)
+    LOD_LIBRARY.clear()
+    for name in MODEL_LIBRARY.values():
+        removeLibraryObject(name)
+    MODEL_LIBRARY.clear()
+
+def resetModelLibraryStats():
+    MODEL_LIBRARY_STATS['hits'] = 0
+    MODEL_LIBRARY_STATS['misses'] = 0
+    MODEL_LIBRARY_STATS['baked'] = 0
+
+def printModelLibraryStats():
+    hits = MODEL_LIBRARY_STATS['hits']
+    misses = MODEL_LIBRARY_STATS['misses']
+    total = hits + misses
+    print("\nModel library: ", hits, "hits, ", misses, "loads (" + str(MODEL_LIBRARY_STATS['baked']), "from the baked library), ", len(MODEL_LIBRARY), "models cached", "(hit rate: " + floatFormat(100.0*hits/total if total > 0 else 0) + "%)")
+
+
+
+
+#############################
+# Level of detail
+
+# The variants of a template are created on first use: a copy of it with a
+# Decimate modifier applied, level k keeping 0.5^k of the faces. The face
+# count follows the image area the target covers, so every halving of the
+# area below the full detail radius drops one level.
+def getProjectedRadius(scene, cam, location, radius):
+    K, width, height = getCameraIntrinsics(scene, cam)
+    depth = getCameraExtrinsics(cam).dot(np.append(np.array(location), 1.0))[2]
+    if depth <= 0:
+        return float('inf')
+    return K[1][1] * radius / depth
+
+def getLodLevel(addonData, pixelRadius):
+    if pixelRadius >= addonData.lod_radius:
+        return 0
+    if pixelRadius <= 0:
+        return addonData.lod_levels
+    return min(addonData.lod_levels, int(math.floor(2 * math.log(addonData.lod_radius / pixelRadius, 2))))
+
+def getTargetLodLevel(context, camName, location, radius):
+    scene = context.scene
+    return getLodLevel(scene.addon_data, getProjectedRadius(scene, scene.objects[camName], location, radius))
+
+def getLodTemplate(context, filePath, template, level):
+    addonData = context.scene.addon_data
+    if level == 0 or template.type != 'MESH' or len(template.data.polygons) < addonData.lod_min_faces:
+        return template
+
+    name = LOD_LIBRARY.get((filePath, level))
+    if name != None and name in bpy.data.objects:
+        return bpy.data.objects[name]
+
+    with StageTimer('lod'):
+        variant = template.copy()
+        modifier = variant.modifiers.new("ofigen_lod", 'DECIMATE')
+        modifier.ratio = 0.5 ** level
+        mesh = variant.to_mesh(context.scene, True, 'RENDER')
+        variant.modifiers.remove(modifier)
+        variant.data = mesh
+        variant.name = template.name + LOD_SUFFIX + str(level)
+        variant.use_fake_user = True
+    countStage('lod_variants')
+    LOD_LIBRARY[(filePath, level)] = variant.name
+    return variant
+
+
+
+
+#############################
+# Baked model library
+
+# The models of the model directory are imported once, joined and origin
+# centered by importModel, and written into one .blend file in the cache
+# directory. The objects are named after a hash of their path relative to the
+# model directory, so the names stay stable when the directory is moved, and
+# carry their bounding tag, dimensions, radius and source path as custom
+# properties. Appending an object from it is much faster than the importers.
+# Every model filter set has its own library, named after the directory and
+# the filters.
+def getBakedLibraryPath(addonData):
+    filters = [os.path.abspath(addonData.data_path_objs), addonData.is_format_obj, addonData.is_format_stl, addonData.is_format_ply, addonData.is_format_3ds,
+        addonData.is_shape_box, addonData.is_shape_sphere, addonData.filename_model_tag]
+    return os.path.join(CACHE_DIR, "models_" + hashlib.sha1(json.dumps(filters).encode('utf-8')).hexdigest() + ".blend")
+
+def getModelRelativePath(directory, filePath):
+    return os.path.relpath(filePath, directory).replace(os.sep, '/')
+
+def getBakedModelName(relPath):
+    return LIB_NAME + '.' + hashlib.sha1(relPath.encode('utf-8')).hexdigest()[:16]
+
+def getBoundingTag(filePath):
+    if BSPHERE in os.path.basename(filePath):
+        return BSPHERE
+    return BBOX
+
+# Only the datablocks the bake created are removed afterwards, the orphans of
+# the open file are kept. The run uses the baked library.
+def bakeModelLibrary(context):
+    addonData = context.scene.addon_data
+    directory = os.path.abspath(addonData.data_path_objs)
+    path = getBakedLibraryPath(addonData)
+    started = time.perf_counter()
+    existing = getDataPointers()
 
+    objs = []
+    try:
+        for filePath in addonData.getModelFileNames():
+            obj = importModel(filePath)
+            if obj == None:
+                continue
+            obj.select = False
+            relPath = getModelRelativePath(directory, filePath)
+            obj.name = getBakedModelName(relPath)
+            obj["ofigen_bound"] = getBoundingTag(filePath)
+            obj["ofigen_dimensions"] = list(obj.dimensions)
+            obj["ofigen_radius"] = getBoundingRadius(obj.dimensions)
+            obj["ofigen_source"] = relPath
+            objs.append(obj)
+
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmpPath = path + "." + str(os.getpid()) + ".tmp"
+        bpy.data.libraries.write(tmpPath, set(objs), fake_user=True)
+        os.replace(tmpPath, path)
+    finally:
+        removeObjects(objs)
+        purgeOrphans(existing)
+    addonData.is_baked_library_used = True
+
+    BAKED_LIBRARY.pop(path, None)
+    print("\nBaked model library: ", len(objs), "models in", floatFormat(time.perf_counter() - started), "s", "(" + path + ")")
+    return path
+
+# The object names of a library, read again when the file changed.
+def getBakedModelNames(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None, set()
+
+    baked = BAKED_LIBRARY.get(path)
+    if baked == None or baked['mtime'] != mtime:
+        with bpy.data.libraries.load(path) as (dataFrom, dataTo):
+            names = set(dataFrom.objects)
+        baked = {'mtime': mtime, 'names': names}
+        BAKED_LIBRARY[path] = baked
+    return baked['mtime'], baked['names']
+
+# Appends the baked object of a model file, None when the model is not baked
+# or its file is newer than the library.
+def loadBakedModel(context, filePath):
+    addonData = context.scene.addon_data
+    if not addonData.is_baked_library_used:
+        return None
+
+    directory = os.path.abspath(addonData.data_path_objs)
+    path = getBakedLibraryPath(addonData)
+    mtime, names = getBakedModelNames(path)
+    name = getBakedModelName(getModelRelativePath(directory, filePath))
+    if name not in names or os.path.getmtime(filePath) > mtime:
+        return None
+
+    with bpy.data.libraries.load(path) as (dataFrom, dataTo):
+        dataTo.objects = [name]
+    return dataTo.objects[0]
+
+
+
+
+#############################
+# Background pool
+
+# The plane imported for the first background is kept (fake user) and only its
+# image is swapped: in the texture slots (Blender Internal) and in the image
+# nodes (Cycles) of its materials. The images stay loaded in the pool.
+def getPlaneImage(obj):
+    for material in obj.data.materials:
+        if material == None:
+            continue
+        for slot in getattr(material, 'texture_slots', []):
+            if slot != None and slot.texture != None and slot.texture.type == 'IMAGE' and slot.texture.image != None:
+                return slot.texture.image
+        if material.node_tree != None:
+            for node in material.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image != None:
+                    return node.image
+    return None
+
+def setPlaneImage(obj, image):
+    for material in obj.data.materials:
+        if material == None:
+            continue
+        for slot in getattr(material, 'texture_slots', []):
+            if slot != None and slot.texture != None and slot.texture.type == 'IMAGE':
+                slot.texture.image = image
+        if material.node_tree != None:
+            for node in material.node_tree.nodes:
+                if node.type == 'TEX_IMAGE':
+                    node.image = image
+
+# Same size as addImage + resizeImage: the height is 0.9*dist, the width follows the aspect.
+def fitImagePlane(obj, image, distFromCam):
+    width, height = image.size
+    aspect = width / float(height) if height > 0 else 1.0
+    obj.dimensions = (distFromCam*0.9*aspect, distFromCam*0.9, obj.dimensions.z)
+
+def getImageBytes(image):
+    width, height = image.size
+    return width * height * image.channels * (4 if image.is_float else 1)
+
+def addPoolImage(filePath, image):
+    image.use_fake_user = True
+    BACKGROUND_POOL[filePath] = image.name
+
+def getPoolImage(filePath):
+    name = BACKGROUND_POOL.get(filePath)
+    if name != None and name in bpy.data.images:
+        BACKGROUND_POOL.move_to_end(filePath)
+        BACKGROUND_POOL_STATS['hits'] += 1
+        countStage('background_hits')
+        return bpy.data.images[name]
+
+    BACKGROUND_POOL_STATS['misses'] += 1
+    countStage('background_misses')
+    image = bpy.data.images.load(filePath)
+    addPoolImage(filePath, image)
+    return image
+
+def evictPoolImage(filePath):
+    image = bpy.data.images.get(BACKGROUND_POOL.pop(filePath))
+    if image != None:
+        image.use_fake_user = False
+        if image.users == 0:
+            bpy.data.images.remove(image)
+
+# Drops the least recently used images until the pool fits its size and budget.
+def trimBackgroundPool(maxCount, maxBytes, keep=None):
+    while len(BACKGROUND_POOL) > 0:
+        images = [bpy.data.images.get(name) for name in BACKGROUND_POOL.values()]
+        size = sum([getImageBytes(image) for image in images if image != None])
+        if len(BACKGROUND_POOL) <= maxCount and size <= maxBytes:
+            return
+        oldest = next(iter(BACKGROUND_POOL))
+        if oldest == keep:
+            return
+        evictPoolImage(oldest)
+
+def clearBackgroundPool(keep=None):
+    for filePath in list(BACKGROUND_POOL.keys()):
+        if filePath != keep:
+            evictPoolImage(filePath)
+
+def resetBackgroundPoolStats():
+    BACKGROUND_POOL_STATS['hits'] = 0
+    BACKGROUND_POOL_STATS['misses'] = 0
+
+def printBackgroundPoolStats():
+    hits = BACKGROUND_POOL_STATS['hits']
+    misses = BACKGROUND_POOL_STATS['misses']
+    total = hits + misses
+    print("\nBackground pool: ", hits, "hits, ", misses, "loads, ", len(BACKGROUND_POOL), "images kept", "(hit rate: " + floatFormat(100.0*hits/total if total > 0 else 0) + "%)")
+
+# The pool is keyed by the loaded file: the cached copy of the current render
+# resolution (see getCachedBackground) or the source.
+def setBackgroundImage(context, imgname, filePath, distFromCam):
+    addonData = context.scene.addon_data
+    plane = bpy.data.objects.get(imgname)
+    loadPath = getCachedBackground(context, filePath)
+
+    if plane == None or not plane.use_fake_user:
+        addImage(imgname, loadPath)
+        plane = bpy.data.objects[imgname]
+        plane.use_fake_user = True
+        image = getPlaneImage(plane)
+        BACKGROUND_POOL_STATS['misses'] += 1
+        countStage('background_misses')
+        addPoolImage(loadPath, image)
+    else:
+        if imgname not in bpy.context.scene.objects:
+            bpy.context.scene.objects.link(plane)
+        resetDeltas(plane)
+        image = getPoolImage(loadPath)
+        if getPlaneImage(plane) != image:
+            setPlaneImage(plane, image)
+
+    addonData.background_file = filePath
+    fitImagePlane(plane, image, distFromCam)
+    trimBackgroundPool(addonData.background_pool_size, addonData.background_pool_budget * 1024 * 1024, loadPath)
+
+
+
+
+#############################
+# Background cache
+
+# The backgrounds are photos far larger than the renders. They are converted
+# once into copies downscaled to the render resolution (times the margin) and
+# stored as uncompressed TGA, which decodes without inflating. A copy is named
+# after the content of the source and the resolution it was made for, so an
+# edited image or another resolution gets its own copy.
+def getRenderResolution(scene):
+    scale = scene.render.resolution_percentage / 100.0
+    return int(scene.render.resolution_x * scale), int(scene.render.resolution_y * scale)
+
+def getFileDigest(filePath):
+    sha1 = hashlib.sha1()
+    with open(filePath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def getBackgroundCachePath(filePath, resolution, margin):
+    size = (int(round(resolution[0] * margin)), int(round(resolution[1] * margin)))
+    return os.path.join(BACKGROUND_CACHE_DIR, getFileDigest(filePath) + "_" + str(size[0]) + "x" + str(size[1]) + ".tga")
+
+# The image keeps its aspect, its shorter side (relative to the render) covers the render.
+def getCachedSize(width, height, resolution, margin):
+    scale = min(1.0, max(resolution[0] * margin / width, resolution[1] * margin / height))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+# Written under a temporary name first, so parallel workers never load a partial copy.
+def writeCachedBackground(filePath, cachePath, resolution, margin):
+    image = bpy.data.images.load(filePath)
+    try:
+        width, height = image.size
+        if width == 0 or height == 0:
+            raise RuntimeError("empty image")
+        size = getCachedSize(width, height, resolution, margin)
+        if size != (width, height):
+            image.scale(size[0], size[1])
+
+        if not os.path.isdir(BACKGROUND_CACHE_DIR):
+            os.makedirs(BACKGROUND_CACHE_DIR)
+        tmpPath = cachePath + "." + str(os.getpid()) + ".tmp"
+        image.filepath_raw = tmpPath
+        image.file_format = 'TARGA_RAW'
+        image.save()
+        os.replace(tmpPath, cachePath)
+    finally:
+        bpy.data.images.remove(image)
+
+# Path of the file to load for a background: the cached copy, or the source
+# itself when the cache is disabled or the source couldn't be converted.
+def getCachedBackground(context, filePath):
+    scene = context.scene
+    addonData = scene.addon_data
+    if not addonData.is_background_cache_used:
+        return filePath
+
+    resolution = getRenderResolution(scene)
+    key = (filePath, resolution, addonData.background_cache_margin)
+    if key in BACKGROUND_CACHE:
+        return BACKGROUND_CACHE[key]
+
+    cachePath = filePath
+    try:
+        path = getBackgroundCachePath(filePath, resolution, addonData.background_cache_margin)
+        if not os.path.isfile(path):
+            with StageTimer('background_cache'):
+                writeCachedBackground(filePath, path, resolution, addonData.background_cache_margin)
+            countStage('background_cached')
+        cachePath = path
+    except (IOError, OSError, RuntimeError) as e:
+        print("\nCouldn't cache the background ", filePath, ": ", e)
+
+    BACKGROUND_CACHE[key] = cachePath
+    return cachePath
+
+# Turns the cache on, the run uses the copies it made.
+def preprocessBackgrounds(context):
+    started = time.perf_counter()
+    addonData = context.scene.addon_data
+    addonData.is_background_cache_used = True
+    backgrounds = addonData.getBackgroundFileNames()
+    cached = [filePath for filePath in backgrounds if getCachedBackground(context, filePath) != filePath]
+    print("\nBackground cache: ", len(cached), "of", len(backgrounds), "backgrounds cached in", floatFormat(time.perf_counter() - started), "s", "(" + BACKGROUND_CACHE_DIR + ")")
+
+
+
+
+#############################
+# Add/remove objects 
+
+# A plane kept by the background pool (fake user) is removed as well, so the
+# new plane gets the name and nothing keeps using the old one.
 def addImage(imgname, imgfile):
+    plane = bpy.data.objects.get(imgname)
+    if plane != None:
+        plane.use_fake_user = False
     removeObject(imgname)
 
     bpy.ops.import_image.to_plane(
@@ -658,16 +2166,12 @@ def addImage(imgname, imgfile):
 
 
 def removeObject(name):
-    deleteModel(name)
+    removeObjectsByName([name])
 
 
 
-def addModel(filePath, fileNameBase):    
+def importModel(filePath):
     file_name = os.path.basename(filePath)
-    bounding = BBOX
-
-    if BSPHERE in file_name:
-        bounding = BSPHERE
 
     if '.stl' in file_name:
         bpy.ops.import_mesh.stl(filepath=filePath)
@@ -678,42 +2182,66 @@ def addModel(filePath, fileNameBase):
     elif '.3ds' in file_name:
         bpy.ops.import_scene.autodesk_3ds(filepath=filePath)
     else:
-        return 'ERROR_NO_MODEL_CREATED';    
-
-    createdObjRef = None
-
+        return None
 
     bpy.context.scene.objects.active = bpy.context.selected_objects[0]
     bpy.ops.object.join()
 
     bpy.ops.object.origin_set(type='GEOMETRY_ORIGIN')
 
-    for obj in bpy.context.selected_objects:
-        ID = getUniqueID()
-        obj.name = fileNameBase + '.' + bounding + '.' + str(ID)
-        createdObjRef = obj
-        bpy.context.scene.objects.active = obj
+    return bpy.context.scene.objects.active
 
 
+def addModel(filePath, fileNameBase, useLibrary=True, template=None):    
+    bounding = getBoundingTag(filePath)
+
+    if useLibrary:
+        if template == None:
+            template = getLibraryModel(filePath)
+        if template == None:
+            return 'ERROR_NO_MODEL_CREATED'
+        createdObjRef = template.copy()
+        bpy.context.scene.objects.link(createdObjRef)
+        createdObjRef.select = True
+    else:
+        createdObjRef = importModel(filePath)
+        if createdObjRef == None:
+            return 'ERROR_NO_MODEL_CREATED'
+
+    ID = TARGETS.nextID()
+    createdObjRef.name = fileNameBase + '.' + bounding + '.' + str(ID)
+    bpy.context.scene.objects.active = createdObjRef
+    TARGETS.addTarget(createdObjRef.name, bounding, ID)
 
     return createdObjRef.name
 
 
+# The objects are removed on the data level instead of selecting them for
+# the delete operator: unlinked from the scenes using them, then removed from
+# bpy.data (an object can only be removed once it has no users). Objects with
+# a fake user (the background plane of the pool) are only unlinked. Removed
+# targets leave the registry.
+def removeObjects(objs):
+    for obj in objs:
+        TARGETS.remove(obj.name)
+        for scene in obj.users_scene:
+            scene.objects.unlink(obj)
+        if not obj.use_fake_user:
+            bpy.data.objects.remove(obj)
+
+def removeObjectsByName(names):
+    removeObjects([bpy.data.objects[name] for name in names if name in bpy.data.objects])
+
 def deleteModel(name):
-    try:
-        bpy.ops.object.select_all(action='DESELECT')
-        obj = bpy.data.objects[name]
-        if obj != None:
-            obj.select = True
-            bpy.ops.object.delete() 
-    except:
+    obj = bpy.data.objects.get(name)
+    if obj == None:
         print("\nCouldn't find an object with this name. ", name)
+        return
+    removeObjects([obj])
 
 
 def deleteAllRelated(name):
-    for obj in bpy.context.scene.objects:
-        if obj.name.startswith(name):
-            deleteModel(obj.name)
+    removeObjectsByName([trgtName for trgtName in TARGETS.getTargetNames() if trgtName.startswith(name)])
 
 
 
@@ -734,24 +2262,41 @@ def generateTarget(context, camName, trgtName, index):
 
     chosenFile = modelList[modelIdxRand if isRandUseOfModels else modelIdxOrd]
 
-    nameBapt = addModel(chosenFile, trgtName)
-
-    bboxData = getBBoxDataInvisible(nameBapt)
-    print("Start----------------")
+    # With the library the radius is known from the template, so the linked
+    # duplicate is only created when there is room for it.
+    with StageTimer('model_import'):
+        if addonData.is_model_library_used:
+            template = getLibraryModel(chosenFile)
+            if template == None:
+                return
+            radius = getTemplateRadius(template)
+        else:
+            nameBapt = addModel(chosenFile, trgtName, False)
+            radius = getBBoxDataInvisible(nameBapt).radius
 
-    seedPos, seedRot = getSeedPosition(context, camName, addonData, bboxData, TARGET_OBJECTS, proxC)
+    with StageTimer('placement'):
+        seedPos, seedRot = getSeedPosition(context, camName, addonData, radius, TARGETS, proxC)
 
     if seedPos == None :
-        deleteModel(nameBapt)
+        countStage('placement_failures')
+        if not addonData.is_model_library_used:
+            deleteModel(nameBapt)
         return
+
+    if addonData.is_model_library_used:
+        with StageTimer('model_import'):
+            if addonData.is_lod_used:
+                level = getTargetLodLevel(context, camName, seedPos, radius)
+                template = getLodTemplate(context, chosenFile, template, level)
+                countStage('lod_level_' + str(level))
+            nameBapt = addModel(chosenFile, trgtName, True, template)
     
     addonData.numOfModels = addonData.numOfModels + 1
     changeObjectLocation(nameBapt, seedPos, seedRot)
 
     if addonData.is_init_target_moving == True:
         randomRotateObject(nameBapt, addonData.init_target_rotation_coef, addonData.init_target_rot_constrain_x, addonData.init_target_rot_constrain_y,addonData.init_target_rot_constrain_z )
-    TARGET_OBJECTS.append(DeployedObjData(nameBapt, seedPos, bboxData.radius))
-    print("End----------------", addonData.numOfModels)
+    TARGETS.place(nameBapt, seedPos, radius)
 
 
 def generateBackground(context, camname, imgname, idx=1):
@@ -765,12 +2310,16 @@ def generateBackground(context, camname, imgname, idx=1):
     else:
         i = (idx % (len(backgrounds)-1))
 
-    addonData.background_file = backgrounds[i]
-
-    addImage(imgname, backgrounds[i])    
-
     dist = 30
-    resizeImage(imgname, dist)
+    if addonData.is_background_pool_used:
+        setBackgroundImage(context, imgname, backgrounds[i], dist)
+    elif addonData.is_persistent_rig and (imgname in bpy.context.scene.objects) and addonData.background_file == backgrounds[i]:
+        resetDeltas(bpy.context.scene.objects[imgname])
+    else:
+        addonData.background_file = backgrounds[i]
+        addImage(imgname, getCachedBackground(context, backgrounds[i]))
+        resizeImage(imgname, dist)
+
     pos, rotQ = createRandomSeedPosition(context, camname, dist, 0.05)
 
     changeObjectLocation(imgname, pos, rotQ)
@@ -790,26 +2339,626 @@ def addLight(context, location, rotationEuler, lightType, lightName):
 
 
 
+def getLightSetup(cam):
+    cl = cam.location
+    return [
+        (LAMP_NAME, 'POINT', ( 3+cl.x, -6+cl.y, 7+cl.z), (radians(90), radians(0), radians(0))),
+        (SUN_NAME,  'SUN',   (-3+cl.x, -6+cl.y, 7+cl.z), (radians(60), radians(0), radians(0))),
+    ]
+
 def setupLight(context, camName):
     cam = bpy.context.scene.objects[camName]
 
     removeObject(LAMP_NAME)
     removeObject(SUN_NAME)
 
-    cl = cam.location
-    addLight(context,  (3+cl.x, -6+cl.y, 7+cl.z), (radians(90), radians(0), radians(0)), 'POINT', LAMP_NAME)
-    addLight(context, (-3+cl.x, -6+cl.y, 7+cl.z), (radians(60), radians(0), radians(0)), 'SUN', SUN_NAME)
+    for lightName, lightType, location, rotationEuler in getLightSetup(cam):
+        addLight(context, location, rotationEuler, lightType, lightName)
+
+def resetLight(context, camName):
+    cam = bpy.context.scene.objects[camName]
+
+    for lightName, lightType, location, rotationEuler in getLightSetup(cam):
+        resetTransform(bpy.context.scene.objects[lightName], location, rotationEuler)
 
 
 
 #############################
 # Render
 
+# Settings per engine: Cycles samples/bounces/denoising, Blender Internal
+# anti-aliasing samples. Settings the running Blender lacks are skipped.
+RENDER_PROFILES = {
+    'DRAFT': {'percentage': 50, 'samples': 16, 'aa_samples': '5', 'bounces': 2, 'tile': 32, 'simplify': True, 'subdivision': 0, 'denoise': True},
+    'PREVIEW': {'percentage': 75, 'samples': 64, 'aa_samples': '8', 'bounces': 4, 'tile': 64, 'simplify': True, 'subdivision': 2, 'denoise': True},
+    'PRODUCTION': {'percentage': 100, 'samples': 256, 'aa_samples': '16', 'bounces': 8, 'tile': 64, 'simplify': False, 'subdivision': 6, 'denoise': False},
+}
+
+# The settings a profile changes, by owner: the render settings, the Cycles
+# settings of the scene and of the active render layer.
+PROFILE_SETTINGS = (
+    ('render', ('resolution_percentage', 'tile_x', 'tile_y', 'threads_mode', 'use_simplify', 'simplify_subdivision', 'use_antialiasing', 'antialiasing_samples')),
+    ('cycles', ('samples', 'max_bounces', 'min_bounces')),
+    ('layer', ('use_denoising',)),
+)
+
+def getProfileSettingsOwner(scene, owner):
+    if owner == 'render':
+        return scene.render
+    if owner == 'cycles':
+        return getattr(scene, 'cycles', None)
+    return getattr(scene.render.layers.active, 'cycles', None)
+
+# The settings of the scene are saved before the first profile is applied
+# and restored for 'CUSTOM', after a calibration too.
+def saveRenderSettings(scene):
+    if scene.name in RENDER_SNAPSHOTS:
+        return
+    snapshot = []
+    for owner, names in PROFILE_SETTINGS:
+        settings = getProfileSettingsOwner(scene, owner)
+        for name in names:
+            if settings != None and hasattr(settings, name):
+                snapshot.append((owner, name, getattr(settings, name)))
+    RENDER_SNAPSHOTS[scene.name] = snapshot
+
+def restoreRenderSettings(scene):
+    snapshot = RENDER_SNAPSHOTS.pop(scene.name, None)
+    if snapshot == None:
+        return
+    for owner, name, value in snapshot:
+        settings = getProfileSettingsOwner(scene, owner)
+        if settings != None:
+            setattr(settings, name, value)
+
+# A thread count given to Blender (-t N, the farm sets one per worker) is kept.
+def hasCommandLineThreads():
+    argv = sys.argv[:sys.argv.index('--')] if '--' in sys.argv else sys.argv
+    return '-t' in argv or '--threads' in argv
+
+def applyRenderProfile(scene, profile):
+    saveRenderSettings(scene)
+    settings = RENDER_PROFILES[profile]
+    render = scene.render
+
+    render.resolution_percentage = settings['percentage']
+    render.tile_x = settings['tile']
+    render.tile_y = settings['tile']
+    if not hasCommandLineThreads():
+        render.threads_mode = 'AUTO'
+    render.use_simplify = settings['simplify']
+    render.simplify_subdivision = settings['subdivision']
+    render.use_antialiasing = True
+    render.antialiasing_samples = settings['aa_samples']
+
+    if hasattr(scene, 'cycles'):
+        scene.cycles.samples = settings['samples']
+        scene.cycles.max_bounces = settings['bounces']
+        scene.cycles.min_bounces = 0
+    layerSettings = getattr(render.layers.active, 'cycles', None)
+    if layerSettings != None and hasattr(layerSettings, 'use_denoising'):
+        layerSettings.use_denoising = settings['denoise']
+
+def applyRenderSettings(context):
+    addonData = context.scene.addon_data
+    if addonData.is_persistent_data:
+        bpy.context.scene.render.use_persistent_data = True
+    if addonData.render_profile != 'CUSTOM':
+        applyRenderProfile(bpy.context.scene, addonData.render_profile)
+    else:
+        restoreRenderSettings(bpy.context.scene)
+
+    # With 'SCENE' the output settings of the .blend file are kept.
+    settings = bpy.context.scene.render.image_settings
+    if addonData.image_format == 'SCENE':
+        return
+    if addonData.image_format == 'EXR':
+        settings.file_format = 'OPEN_EXR'
+        settings.color_depth = '32' if addonData.image_color_depth == '32' else '16'
+    else:
+        settings.file_format = 'PNG'
+        settings.color_depth = '8' if addonData.image_color_depth == '8' else '16'
+        settings.compression = int(math.ceil(addonData.png_compression * 100 / 9.0))
+
+# The images are captured from the compositor when the background writer is
+# used, except with optical flow: then the Viewer node holds the flow passes.
+# A scene format the writer can't encode (JPEG, TIFF, ...) or a view it doesn't
+# apply (see isViewEncoded) is written by Blender.
+def isImageCaptured(addonData):
+    return addonData.is_async_output and not addonData.is_flow_output and isViewEncoded(bpy.context.scene)
+
 def render(context, name):
-    bpy.context.scene.render.filepath = context.scene.addon_data.data_path_out + name + ".png"
-    bpy.ops.render.render(write_still=True, use_viewport=True)
+    addonData = context.scene.addon_data
+    filepath = addonData.data_path_out + name + getImageExtension(addonData)
+    applyRenderSettings(context)
+
+    countStage('renders')
+    if isImageCaptured(addonData):
+        with StageTimer('render'):
+            setupImageCapture(bpy.context.scene)
+            bpy.ops.render.render(use_viewport=True)
+            pixels = readViewerPixels()
+        with StageTimer('write'):
+            submitOutput(writeImage, filepath, pixels, ImageOutput(context))
+    else:
+        with StageTimer('render'):
+            bpy.context.scene.render.filepath = filepath
+            bpy.ops.render.render(write_still=True, use_viewport=True)
+
+
+# Two snapshot animation: the state before and after the move is keyframed on
+# frame 1 and 2, so both images are rendered by a single animation job.
+ANIMATED_PATHS = ('delta_location', 'delta_rotation_euler')
+
+def getMovingObjects(context):
+    objs = [bpy.context.scene.objects[name] for name in getDeployedTargetNames(context)]
+    for name in (CAM_NAME, IMG_NAME):
+        if name in bpy.context.scene.objects:
+            objs.append(bpy.context.scene.objects[name])
+    return objs
+
+def keyframeMotion(context, frame):
+    for obj in getMovingObjects(context):
+        obj.rotation_mode = 'XYZ'
+        for path in ANIMATED_PATHS:
+            obj.keyframe_insert(data_path=path, frame=frame)
+        for fcurve in obj.animation_data.action.fcurves:
+            for point in fcurve.keyframe_points:
+                point.interpolation = 'CONSTANT'
+
+def clearMotion(context):
+    for obj in getMovingObjects(context):
+        obj.animation_data_clear()
+
+def renderMotion(context, name, isFlow):
+    scene = bpy.context.scene
+    frames = []
+
+    def captureFrame(scene):
+        frames.append(captureFlowFrame(context, CAM_NAME))
+
+    applyRenderSettings(context)
+    scene.frame_start = 1
+    scene.frame_end = 2
+    scene.render.filepath = context.scene.addon_data.data_path_out + name + ".#"
+
+    countStage('renders', 2)
+    if isFlow:
+        bpy.app.handlers.render_write.append(captureFrame)
+    try:
+        with StageTimer('render'):
+            bpy.ops.render.render(animation=True, use_viewport=True)
+    finally:
+        if isFlow:
+            bpy.app.handlers.render_write.remove(captureFrame)
+
+    return frames
+
+
+
+
+
+#############################
+# Render profile calibration
+
+CALIBRATION_PROFILES = ('PRODUCTION', 'PREVIEW', 'DRAFT')
+CALIBRATION_RENDERS = 3
+
+def renderCapture(context):
+    setupImageCapture(bpy.context.scene)
+    started = time.time()
+    bpy.ops.render.render(use_viewport=True)
+    seconds = time.time() - started
+    return readViewerPixels(), seconds
+
+# The lower resolutions are compared after a nearest neighbour upscale, so the
+# lost resolution counts as error.
+def getPSNR(reference, image):
+    height, width = reference.shape[:2]
+    rows = np.arange(height) * image.shape[0] // height
+    cols = np.arange(width) * image.shape[1] // width
+    image = image[rows][:, cols]
+    mse = np.mean((reference[:, :, :3] - image[:, :, :3]) ** 2)
+    return float('inf') if mse == 0 else 10 * math.log10(1.0 / mse)
+
+# Renders one sample of the run with every profile (after an untimed warm up)
+# and picks the fastest one that is within the PSNR threshold of production.
+# A profile is timed by the median of several renders on the CPU. The render
+# settings and the device of the scene are restored afterwards, the chosen
+# profile is applied before the next render.
+def calibrateRenderProfile(context, idx=0):
+    addonData = context.scene.addon_data
+    cycles = getattr(context.scene, 'cycles', None)
+    output = ImageOutput(context)
+    images = {}
+    results = {}
+    previous = addonData.render_profile
+    device = cycles.device if cycles != None else None
+
+    buildSample(context, idx)
+    try:
+        if cycles != None:
+            cycles.device = 'CPU'
+        addonData.render_profile = 'DRAFT'
+        applyRenderSettings(context)
+        renderCapture(context)
+
+        for profile in CALIBRATION_PROFILES:
+            addonData.render_profile = profile
+            applyRenderSettings(context)
+            times = []
+            for i in range(CALIBRATION_RENDERS):
+                pixels, seconds = renderCapture(context)
+                times.append(seconds)
+            images[profile] = toDisplay(pixels, output)
+            results[profile] = {"seconds": float(np.median(times)), "renders": times}
+    finally:
+        addonData.render_profile = previous
+        restoreRenderSettings(context.scene)
+        if cycles != None:
+            cycles.device = device
+        releaseSample(context)
+
+    chosen = 'PRODUCTION'
+    for profile in CALIBRATION_PROFILES:
+        psnr = getPSNR(images['PRODUCTION'], images[profile])
+        results[profile]["psnr"] = jsonFloat(psnr)
+        results[profile]["accepted"] = psnr >= addonData.calibration_psnr
+        if results[profile]["accepted"] and results[profile]["seconds"] < results[chosen]["seconds"]:
+            chosen = profile
+        print("Calibration:", profile, floatFormat(results[profile]["seconds"]), "s,", floatFormat(psnr), "dB")
+
+    addonData.render_profile = chosen
+    print("Calibration: using the", chosen, "profile (min PSNR:", floatFormat(addonData.calibration_psnr), "dB)")
+    writeOutput(context, [json.dumps({"profile": chosen, "min_psnr": addonData.calibration_psnr, "profiles": results}, indent=2)], CALIBRATION_NAME)
+    return chosen, results
+
+
 
 
+#############################
+# Optical flow
+
+class FlowFrame:
+   def __init__(self, depth, index, camera, matrices):
+        self.depth = depth
+        self.index = index
+        self.camera = camera
+        self.matrices = matrices
+
+
+# The depth and the object index passes (or the image itself, see
+# setupImageCapture) are routed into the 'Viewer Node' image by the
+# compositor, so they can be read back after each render.
+def getCaptureNodes(scene):
+    scene.use_nodes = True
+    scene.render.use_compositing = True
+
+    tree = scene.node_tree
+    nodes = tree.nodes
+    if (PASS_COMBINE_NAME in nodes) and (PASS_VIEWER_NAME in nodes):
+        layerNode = nodes[PASS_COMBINE_NAME].inputs['R'].links[0].from_node
+        return layerNode, nodes[PASS_COMBINE_NAME], nodes[PASS_VIEWER_NAME]
+
+    layerNode = None
+    compositeNode = None
+    for node in nodes:
+        if node.type == 'R_LAYERS' and layerNode == None:
+            layerNode = node
+        elif node.type == 'COMPOSITE':
+            compositeNode = node
+
+    if layerNode == None:
+        layerNode = nodes.new('CompositorNodeRLayers')
+    if compositeNode == None:
+        compositeNode = nodes.new('CompositorNodeComposite')
+        tree.links.new(layerNode.outputs['Image'], compositeNode.inputs['Image'])
+
+    combine = nodes.new('CompositorNodeCombRGBA')
+    combine.name = PASS_COMBINE_NAME
+    viewer = nodes.new('CompositorNodeViewer')
+    viewer.name = PASS_VIEWER_NAME
+
+    tree.links.new(layerNode.outputs['Z'], combine.inputs['R'])
+    tree.links.new(layerNode.outputs['IndexOB'], combine.inputs['G'])
+    nodes.active = viewer
+    return layerNode, combine, viewer
+
+def linkViewer(scene, viewer, socket):
+    links = viewer.inputs['Image'].links
+    if len(links) == 0 or links[0].from_socket != socket:
+        scene.node_tree.links.new(socket, viewer.inputs['Image'])
+
+def setupPassCapture(scene):
+    layer = scene.render.layers.active
+    layer.use_pass_z = True
+    layer.use_pass_object_index = True
+
+    layerNode, combine, viewer = getCaptureNodes(scene)
+    linkViewer(scene, viewer, combine.outputs['Image'])
+
+def setupImageCapture(scene):
+    layerNode, combine, viewer = getCaptureNodes(scene)
+    linkViewer(scene, viewer, layerNode.outputs['Image'])
+
+# Rows from the top, like the image files.
+def readViewerPixels():
+    img = bpy.data.images[VIEWER_IMAGE]
+    width, height = img.size
+    return np.array(img.pixels[:], dtype=np.float32).reshape(height, width, 4)[::-1]
+
+# Only the targets and the background get an index, the other objects keep 0.
+def getPassObjectNames(context, trgtName, imgName):
+    return [name for name in getDeployedTargetNames(context) if name.startswith(trgtName)] + [imgName]
+
+def assignPassIndices(context, trgtName, imgName):
+    index = 1
+    for name in getPassObjectNames(context, trgtName, imgName):
+        obj = bpy.context.scene.objects.get(name)
+        if obj != None:
+            obj.pass_index = index
+            index = index + 1
+
+def prepareFlow(context, trgtName, imgName):
+    setupPassCapture(context.scene)
+    assignPassIndices(context, trgtName, imgName)
+
+def readPasses(scene, K):
+    pixels = readViewerPixels()
+    height, width = pixels.shape[:2]
+
+    depth = pixels[:, :, 0].astype(np.float64)
+    index = np.rint(pixels[:, :, 1]).astype(np.int32)
+
+    # Cycles stores the distance from the camera, not the depth along its axis.
+    if scene.render.engine == 'CYCLES':
+        depth = depth / np.linalg.norm(getPixelRays(K, width, height), axis=2)
+
+    return depth, index
+
+def getPixelRays(K, width, height):
+    u, v = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    pixels = np.stack((u, v, np.ones_like(u)), axis=2)
+    return pixels.dot(np.linalg.inv(K).T)
+
+def captureFlowFrame(context, camName):
+    with StageTimer('flow_capture'):
+        return readFlowFrame(context, camName)
+
+def readFlowFrame(context, camName):
+    scene = bpy.context.scene
+    cam = bpy.data.objects[camName]
+    K, width, height = getCameraIntrinsics(scene, cam)
+    depth, index = readPasses(scene, K)
+
+    matrices = {}
+    for name in getPassObjectNames(context, TARGET_NAME, IMG_NAME):
+        obj = scene.objects.get(name)
+        if obj != None and obj.pass_index > 0:
+            matrices[obj.pass_index] = np.array(obj.matrix_world)
+
+    return FlowFrame(depth, index, getCameraExtrinsics(cam), matrices)
+
+# Every pixel of the first snapshot is lifted into the world with its depth,
+# moved with the motion of the object it belongs to and projected with the
+# camera of the second snapshot.
+def computeFlow(K, frame1, frame2):
+    height, width = frame1.depth.shape
+    valid = frame1.depth < DEPTH_FAR
+
+    points = getPixelRays(K, width, height) * np.where(valid, frame1.depth, 0)[:, :, None]
+    R1, t1 = frame1.camera[:, :3], frame1.camera[:, 3]
+    points = (points - t1).dot(R1).reshape(-1, 3)
+
+    index = frame1.index.reshape(-1)
+    moved = points.copy()
+    for idx, matrix in frame1.matrices.items():
+        if idx not in frame2.matrices:
+            continue
+        T = frame2.matrices[idx].dot(np.linalg.inv(matrix))
+        mask = index == idx
+        moved[mask] = points[mask].dot(T[:3, :3].T) + T[:3, 3]
+
+    uv, depth2 = projectPoints(K.dot(frame2.camera), moved)
+    uv = uv.reshape(height, width, 2)
+    depth2 = depth2.reshape(height, width)
+
+    u, v = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    flow = uv - np.stack((u, v), axis=2)
+    valid = valid & (depth2 > 0)
+    flow[~valid] = FLOW_UNKNOWN
+
+    x = np.floor(uv[:, :, 0])
+    y = np.floor(uv[:, :, 1])
+    inside = valid & (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    xi = np.where(inside, x, 0).astype(np.int64)
+    yi = np.where(inside, y, 0).astype(np.int64)
+    visible = inside & (depth2 <= frame2.depth[yi, xi] * 1.01 + 0.01)
+    occlusion = (~visible).astype(np.uint8)
+
+    return flow.astype(np.float32), occlusion
+
+# Middlebury .flo: tag, width, height, then the (u, v) pairs row by row.
+def writeFlo(filepath, flow):
+    height, width = flow.shape[:2]
+    with open(filepath, 'wb') as fh:
+        np.array([FLOW_TAG], dtype='<f4').tofile(fh)
+        np.array([width, height], dtype='<i4').tofile(fh)
+        flow.astype('<f4').tofile(fh)
+
+def saveFlow(path, K, frame1, frame2, isOcclusion, isDepth):
+    flow, occlusion = computeFlow(K, frame1, frame2)
+
+    writeFlo(path + ".flo", flow)
+    if isOcclusion:
+        np.save(path + ".occ.npy", occlusion)
+    if isDepth:
+        np.save(path + ".1.depth.npy", frame1.depth.astype(np.float32))
+        np.save(path + ".2.depth.npy", frame2.depth.astype(np.float32))
+
+def writeFlow(context, camName, frame1, frame2, filename):
+    addonData = context.scene.addon_data
+    K, width, height = getCameraIntrinsics(bpy.context.scene, bpy.data.objects[camName])
+    with StageTimer('write'):
+        submitOutput(saveFlow, addonData.data_path_out + filename, K, frame1, frame2, addonData.is_flow_occlusion, addonData.is_flow_depth)
+
+
+
+
+#############################
+# Memory
+
+ORPHAN_COLLECTIONS = ('meshes', 'materials', 'textures', 'images', 'lamps', 'cameras', 'actions')
+# Images Blender keeps without users, they are rendered into.
+KEPT_IMAGE_TYPES = ('RENDER_RESULT', 'COMPOSITING')
+
+# The datablocks without users are what the removed objects leave behind. The
+# library templates have a fake user, so they are kept. Removing a mesh can
+# orphan its materials, and so on, so it runs until a pass removes nothing.
+# The datablocks in 'kept' (see getDataPointers) are not removed.
+def purgeOrphans(kept=None):
+    removed = 0
+    while True:
+        count = 0
+        for name in ORPHAN_COLLECTIONS:
+            collection = getattr(bpy.data, name)
+            orphans = [block for block in collection if block.users == 0 and getattr(block, 'type', None) not in KEPT_IMAGE_TYPES
+                and (kept == None or block.as_pointer() not in kept[name])]
+            for block in orphans:
+                collection.remove(block)
+            count = count + len(orphans)
+        removed = removed + count
+        if count == 0:
+            return removed
+
+def getDataPointers():
+    return dict([(name, set([block.as_pointer() for block in getattr(bpy.data, name)])) for name in ORPHAN_COLLECTIONS])
+
+# The datablocks of the .blend file when a run starts are kept by its purges,
+# only what the generator leaves behind is removed.
+def keepSceneData():
+    RUN_DATA_POINTERS.clear()
+    RUN_DATA_POINTERS.update(getDataPointers())
+
+# Resident set size in bytes, from /proc on Linux. Elsewhere the peak size
+# from getrusage, or None when neither is available.
+def getMemoryUsage():
+    try:
+        with open('/proc/self/statm', 'r') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def toMegabytes(size):
+    return size / (1024.0 * 1024.0)
+
+def reclaimMemory(context, idx):
+    addonData = context.scene.addon_data
+    if len(RUN_DATA_POINTERS) == 0:
+        keepSceneData()
+
+    interval = addonData.orphan_purge_interval
+    if interval > 0 and (idx + 1) % interval == 0:
+        with StageTimer('purge'):
+            countStage('orphans_removed', purgeOrphans(RUN_DATA_POINTERS))
+
+    if addonData.memory_limit <= 0:
+        return
+    size = getMemoryUsage()
+    if size == None or toMegabytes(size) <= addonData.memory_limit:
+        return
+
+    with StageTimer('purge'):
+        clearModelLibrary()
+        clearBoundLibrary()
+        clearBackgroundPool(getCachedBackground(context, addonData.background_file) if addonData.background_file != "" else None)
+        countStage('orphans_removed', purgeOrphans(RUN_DATA_POINTERS))
+    countStage('memory_purges')
+    after = getMemoryUsage()
+    print("\nMemory: ", floatFormat(toMegabytes(size)), "MB is above the limit of", addonData.memory_limit, "MB after sample", idx, "- libraries and background pool cleared, orphans removed,", floatFormat(toMegabytes(after)), "MB now")
+
+
+
+
+#############################
+# Metrics
+
+# Seconds per stage and counters of the current sample. The work of the writer
+# threads is not included, 'write' is the time the run waited for them.
+class StageTimer:
+   def __init__(self, stage):
+        self.stage = stage
+
+   def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+   def __exit__(self, *args):
+        stages = SAMPLE_METRICS['stages']
+        stages[self.stage] = stages.get(self.stage, 0.0) + time.perf_counter() - self.started
+        return False
+
+def countStage(name, count=1):
+    counts = SAMPLE_METRICS['counts']
+    counts[name] = counts.get(name, 0) + count
+
+def resetSampleMetrics():
+    SAMPLE_METRICS['stages'] = {}
+    SAMPLE_METRICS['counts'] = {}
+
+def writeSampleMetrics(context, folder, idx, name, seconds):
+    size = getMemoryUsage()
+    record = {
+        "index": idx,
+        "name": name,
+        "seconds": seconds,
+        "memory_mb": toMegabytes(size) if size != None else None,
+        "stages": SAMPLE_METRICS['stages'],
+        "counts": SAMPLE_METRICS['counts'],
+    }
+    RUN_METRICS.append(record)
+    appendManifestRecord(os.path.join(context.scene.addon_data.data_path_out, folder + METRICS_NAME), record)
+
+def summarizeMetrics(records, seconds):
+    summary = {
+        "samples": len(records),
+        "seconds": seconds,
+        "samples_per_second": len(records) / seconds if seconds > 0 else 0.0,
+        "stages": {},
+        "counts": {},
+    }
+    if len(records) == 0:
+        return summary
+
+    stages = sorted(set([stage for record in records for stage in record["stages"]]))
+    for stage in stages + ['sample']:
+        values = np.array([record["seconds"] if stage == 'sample' else record["stages"].get(stage, 0.0) for record in records])
+        summary["stages"][stage] = {
+            "total": float(values.sum()),
+            "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+        }
+
+    for record in records:
+        for name, count in record["counts"].items():
+            summary["counts"][name] = summary["counts"].get(name, 0) + count
+    return summary
+
+def printMetricsSummary(summary):
+    print("\nRun: ", summary["samples"], "samples in", floatFormat(summary["seconds"]), "s (" + floatFormat(summary["samples_per_second"]) + " samples/s)")
+    stages = sorted(summary["stages"].items(), key=lambda item: -item[1]["total"])
+    for stage, values in stages:
+        print("   ", stage.ljust(14), "p50:", floatFormat(1000 * values["p50"]).rjust(10), "ms   p95:", floatFormat(1000 * values["p95"]).rjust(10), "ms   total:", floatFormat(values["total"]).rjust(8), "s")
+    for name, count in sorted(summary["counts"].items()):
+        print("   ", name.ljust(14), count)
+
 
 
 
@@ -817,58 +2966,231 @@ def render(context, name):
 # Manager functions
 
 def clearScene(context):   
-    bpy.ops.view3D.snap_cursor_to_center()
-    for obj in bpy.context.scene.objects:
-        obj.select = True
-    bpy.ops.object.delete() 
+    context.scene.cursor_location = (0, 0, 0)
+    removeObjects(list(bpy.context.scene.objects))
     context.scene.addon_data.numOfModels = 0
-    TARGET_OBJECTS = []
-    IDS = []
+    TARGETS.clear()
 
 def setupEnvironment(context):
-    addCamera(context, CAM_NAME, (0, 0, 0), (radians(90), radians(0), radians(0)) )
+    addCamera(context, CAM_NAME, CAM_LOCATION, CAM_ROTATION)
     setupLight(context, CAM_NAME)
 
 
-def RunOnce(context, name="test", subfolder="", idx=1):
+# Persistent rig: the camera, the lamps and the background plane are created
+# once, between the runs only the targets are removed and the rest is reset.
+def isRigReady(context):
+    objects = context.scene.objects
+    return (CAM_NAME in objects) and (LAMP_NAME in objects) and (SUN_NAME in objects)
+
+def resetRig(context):
+    clearMotion(context)
+
+    cam = context.scene.objects[CAM_NAME]
+    resetTransform(cam, CAM_LOCATION, CAM_ROTATION)
+    context.scene.camera = cam
+
+    TARGETS.clear()
+    TARGETS.addObstacle(CAM_NAME, cam.location, 2)
+
+    resetLight(context, CAM_NAME)
+
+    if IMG_NAME in context.scene.objects:
+        resetDeltas(context.scene.objects[IMG_NAME])
+
+def clearTargets(context):
+    boxNames = [getBoundingBoxName(BBOX_NAME, record) for record in TARGETS.getTargets()]
+    removeObjectsByName(TARGETS.getTargetNames() + boxNames)
+    context.scene.addon_data.numOfModels = 0
+
+# Targets the registry doesn't know (e.g. saved with the .blend file) are
+# removed once per run, the samples only remove the registered ones.
+def removeStrayTargets(context):
+    removeObjects([obj for obj in context.scene.objects if (obj.name.startswith(TARGET_NAME) and obj.name not in TARGETS) or obj.name.startswith(BBOX_NAME)])
+
+def prepareScene(context):
+    if context.scene.addon_data.is_persistent_rig and isRigReady(context):
+        with StageTimer('clear'):
+            clearTargets(context)
+        with StageTimer('setup'):
+            resetRig(context)
+    else:
+        with StageTimer('clear'):
+            clearScene(context)
+        with StageTimer('setup'):
+            setupEnvironment(context)
+
+
+def annotateSnapshot(context, filename, isOverlay, isLast):
+    if isOverlay:
+        with StageTimer('bounds'):
+            addBoundingBoxForAll(context, TARGET_NAME, BBOX_NAME)    
+        render(context, filename)
+    with StageTimer('annotation'):
+        frame = extractPictureData(context, TARGET_NAME, CAM_NAME, IMG_NAME)
+    if isOverlay:
+        with StageTimer('bounds'):
+            if isLast:
+                removeBoundingBoxForAll(context, BBOX_NAME)
+            else:
+                hideBoundingBoxForAll(context, BBOX_NAME)
+    return frame
+
+
+def getSampleSeed(runSeed, idx):
+    digest = hashlib.sha1((str(runSeed) + ':' + str(idx)).encode('ascii')).hexdigest()
+    return int(digest[:8], 16)
+
+def getSampleFiles(addonData, name):
+    ext = getImageExtension(addonData)
+    files = {"image_1": name + ".1" + ext, "image_2": name + ".2" + ext}
+    if addonData.is_overlay_rendered:
+        files["overlay_1"] = name + ".1b" + ext
+        files["overlay_2"] = name + ".2b" + ext
+    if addonData.is_flow_output:
+        files["flow"] = name + ".flo"
+        if addonData.is_flow_occlusion:
+            files["occlusion"] = name + ".occ.npy"
+        if addonData.is_flow_depth:
+            files["depth_1"] = name + ".1.depth.npy"
+            files["depth_2"] = name + ".2.depth.npy"
+    return files
+
+
+# Sets up the scene of the sample: background and targets, not moved yet.
+def buildSample(context, idx):
     addonData = context.scene.addon_data
 
+    seed = getSampleSeed(addonData.run_seed, idx)
+    random.seed(seed)
+
     if addonData.is_random_number_of_models == True:
         objcount = random.randint(1,addonData.max_number_of_models)
     else:
         objcount = addonData.max_number_of_models
 
-    clearScene(context)
-    setupEnvironment(context)
-    generateBackground(context, CAM_NAME, IMG_NAME, idx)
+    prepareScene(context)
+    with StageTimer('background'):
+        generateBackground(context, CAM_NAME, IMG_NAME, idx)
 
     for x in range(objcount):
         generateTarget(context, CAM_NAME, TARGET_NAME, x)
 
-    render(context, subfolder + name + ".1")
-    addBoundingBoxForAll(context, TARGET_NAME, BBOX_NAME)    
-    render(context, subfolder + name + ".1b")
-    extractPictureData(context, TARGET_NAME, CAM_NAME, IMG_NAME, subfolder + name + ".1b")
-    removeBoundingBoxForAll(context, BBOX_NAME)
+    return seed
 
-    moveAllAsConfigSays(context)
+def releaseSample(context):
+    with StageTimer('clear'):
+        if context.scene.addon_data.is_persistent_rig:
+            clearTargets(context)
+        else:
+            clearScene(context)
 
-    render(context, subfolder + name + ".2")
-    addBoundingBoxForAll(context, TARGET_NAME, BBOX_NAME)    
-    render(context, subfolder + name + ".2b")
-    extractPictureData(context, TARGET_NAME, CAM_NAME, IMG_NAME, subfolder + name + ".2b")
-    removeBoundingBoxForAll(context, BBOX_NAME)
 
-    extractSceneConfigData(context, TARGET_NAME, CAM_NAME, subfolder + name + ".c")
+def RunOnce(context, name="test", subfolder="", idx=1):
+    resetSampleMetrics()
+    started = time.perf_counter()
+
+    addonData = context.scene.addon_data
+    seed = buildSample(context, idx)
+
+    isOverlay = addonData.is_overlay_rendered
+    isFlow = addonData.is_flow_output
+    basePath = subfolder + name
+
+    if isFlow:
+        prepareFlow(context, TARGET_NAME, IMG_NAME)
+
+    if addonData.is_animation_render and not isImageCaptured(addonData):
+        keyframeMotion(context, 1)
+        with StageTimer('move'):
+            moveAllAsConfigSays(context)
+        keyframeMotion(context, 2)
+
+        flowFrames = renderMotion(context, basePath, isFlow)
+        if isFlow:
+            writeFlow(context, CAM_NAME, flowFrames[0], flowFrames[1], basePath)
+
+        bpy.context.scene.frame_set(1)
+        frame1 = annotateSnapshot(context, basePath + ".1b", isOverlay, False)
+        bpy.context.scene.frame_set(2)
+        frame2 = annotateSnapshot(context, basePath + ".2b", isOverlay, True)
+        clearMotion(context)
+    else:
+        render(context, basePath + ".1")
+        if isFlow:
+            flowFrame1 = captureFlowFrame(context, CAM_NAME)
+        frame1 = annotateSnapshot(context, basePath + ".1b", isOverlay, False)
+
+        with StageTimer('move'):
+            moveAllAsConfigSays(context)
+
+        render(context, basePath + ".2")
+        if isFlow:
+            flowFrame2 = captureFlowFrame(context, CAM_NAME)
+            writeFlow(context, CAM_NAME, flowFrame1, flowFrame2, basePath)
+        frame2 = annotateSnapshot(context, basePath + ".2b", isOverlay, True)
+
+    # The record is written last, so it marks the sample as complete.
+    with StageTimer('write'):
+        finishSample(writeSampleRecord, OutputSettings(context, subfolder), {
+            "index": idx,
+            "name": name,
+            "seed": seed,
+            "config": writeSceneConfig(context, subfolder),
+            "num_of_models": addonData.numOfModels,
+            "files": getSampleFiles(addonData, name),
+            "frames": [frame1, frame2],
+        })
+
+    countStage('targets', addonData.numOfModels)
+    releaseSample(context)
+    reclaimMemory(context, idx)
+    writeSampleMetrics(context, subfolder, idx, name, time.perf_counter() - started)
+
+
+def RunRange(context, basename="test", folder="", start=0, stop=1):
+    resetModelLibraryStats()
+    resetBackgroundPoolStats()
+    refreshAssetIndex(context)
+    removeStrayTargets(context)
+    keepSceneData()
 
-    clearScene(context)
+    addonData = context.scene.addon_data
+    completed = readManifestNames(context, folder) if addonData.is_resume else set()
+    # Samples of a shard that was not written before a crash are generated again.
+    if addonData.is_resume and isAnnotationBackend(addonData, 'NPZ'):
+        completed = completed & readAnnotationShardNames(context, folder)
+    if addonData.is_resume:
+        filterResumedRecords(context, folder, completed)
+    else:
+        resetRunRecords(context, folder)
 
+    del RUN_METRICS[:]
+    started = time.perf_counter()
+
+    openOutputPool(context)
+    try:
+        for n in range(start, stop):
+            name = basename +'_'+ str(n)
+            if name in completed:
+                continue
+            RunOnce(context, name, folder, n)
+    finally:
+        try:
+            closeOutputPool()
+        finally:
+            closeAnnotationWriters()
+            closeTarWriters()
+            closeManifestWriters()
+
+    printModelLibraryStats()
+    printBackgroundPoolStats()
+    summary = summarizeMetrics(RUN_METRICS, time.perf_counter() - started)
+    printMetricsSummary(summary)
+    writeOutput(context, [json.dumps(summary, indent=2, sort_keys=True)], folder + METRICS_SUMMARY_NAME)
 
 def RunNTimes(context, basename="test", folder=""):
     addonData = context.scene.addon_data
-
-    for n in range(addonData.run_iterations):
-        RunOnce(context, basename +'_'+ str(n), folder, n)
+    RunRange(context, basename, folder, 0, addonData.run_iterations)
 
 
 
@@ -903,8 +3225,9 @@ class Run(bpy.types.Operator):
 
     def execute(self, context):
 
-        DeleteFiles(context, "data\\")
-        RunNTimes(context, "img", "data\\");
+        if not context.scene.addon_data.is_resume:
+            DeleteFiles(context, os.path.join("data", ""))
+        RunNTimes(context, "img", os.path.join("data", ""));
         
         return {'FINISHED'}
 
@@ -913,6 +3236,51 @@ class Run(bpy.types.Operator):
 
 
 
+class RefreshAssetIndex(bpy.types.Operator):
+    """Scan the model, background and bounding directories again."""
+    bl_idname = "myops.refreshindex"
+    bl_label = "Refresh asset index"
+
+    def execute(self, context):
+        refreshAssetIndex(context, True)
+        return {'FINISHED'}
+
+
+class PreprocessBackgrounds(bpy.types.Operator):
+    """Convert every background into the cache, downscaled to the render resolution."""
+    bl_idname = "myops.preprocessbackgrounds"
+    bl_label = "Preprocess backgrounds"
+
+    def execute(self, context):
+        refreshAssetIndex(context)
+        preprocessBackgrounds(context)
+        return {'FINISHED'}
+
+
+class BakeModelLibrary(bpy.types.Operator):
+    """Import every model of the model directory (current filters) into one .blend library."""
+    bl_idname = "myops.bakelibrary"
+    bl_label = "Bake model library"
+
+    def execute(self, context):
+        refreshAssetIndex(context)
+        bakeModelLibrary(context)
+        return {'FINISHED'}
+
+
+class CalibrateRenderProfile(bpy.types.Operator):
+    """Render a sample with every profile and select the fastest one within the PSNR threshold."""
+    bl_idname = "myops.calibrate"
+    bl_label = "Calibrate profile"
+
+    def execute(self, context):
+        refreshAssetIndex(context)
+        calibrateRenderProfile(context)
+        return {'FINISHED'}
+
+
+
+
 ## Unit tests
 class TestButton1(bpy.types.Operator):
     """Remove everything."""
@@ -997,8 +3365,6 @@ class TestButton3d(bpy.types.Operator):
     bl_label = "DONE - Remove targets"
 
     def execute(self, context):        
-        TARGET_OBJECTS = []    
-        IDS = []
         context.scene.addon_data.numOfModels = 0
         deleteAllRelated(TARGET_NAME)        
         return {'FINISHED'}
@@ -1030,7 +3396,8 @@ class TestButton6(bpy.types.Operator):
     
     def execute(self, context):
         # extractBBoxData(context, BBOX_NAME)
-        extractPictureData(context, TARGET_NAME, CAM_NAME, IMG_NAME)
+        frame = extractPictureData(context, TARGET_NAME, CAM_NAME, IMG_NAME)
+        writeOutput(context, [json.dumps(frame, indent=2)], "file.json")
 
         return {'FINISHED'}
 
@@ -1089,7 +3456,7 @@ class TestButton8(bpy.types.Operator):
     bl_label = "DONE  - Render"
     
     def execute(self, context):
-        render(context, "test\\render")
+        render(context, os.path.join("test", "render"))
         return {'FINISHED'}
 
 class TestButton9(bpy.types.Operator):
@@ -1099,8 +3466,9 @@ class TestButton9(bpy.types.Operator):
     
     def execute(self, context):
 
-        DeleteFiles(context, "test\\once\\")
-        RunOnce(context, "tst", "test\\once\\")
+        DeleteFiles(context, os.path.join("test", "once", ""))
+        keepSceneData()
+        RunOnce(context, "tst", os.path.join("test", "once", ""))
         
         return {'FINISHED'}
 
@@ -1164,6 +3532,8 @@ class OfigenConfigPanel( View3DPanel, bpy.types.Panel):
         sub.prop(addonData, "is_shape_box")
         sub.prop(addonData, "is_shape_sphere")
         layout.separator()
+        layout.operator("myops.refreshindex")
+        layout.operator("myops.bakelibrary")
         
 class OfigenPropertiesPanel( View3DPanel, bpy.types.Panel):
     bl_label = "Properties"
@@ -1188,6 +3558,42 @@ class OfigenPropertiesPanel( View3DPanel, bpy.types.Panel):
         layout.prop(addonData, "is_random_number_of_models")
         layout.prop(addonData, "is_randomize_the_use_of_models")
         layout.prop(addonData, "is_randomize_the_use_of_images")
+        layout.prop(addonData, "is_model_library_used")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_model_library_used
+        sub.prop(addonData, "is_baked_library_used")
+        layout.prop(addonData, "is_lod_used")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_lod_used and addonData.is_model_library_used
+        sub.prop(addonData, "lod_levels")
+        sub.prop(addonData, "lod_min_faces")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_lod_used and addonData.is_model_library_used
+        sub.prop(addonData, "lod_radius")
+        layout.prop(addonData, "is_persistent_rig")
+        layout.prop(addonData, "is_background_pool_used")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_background_pool_used
+        sub.prop(addonData, "background_pool_size")
+        sub.prop(addonData, "background_pool_budget")
+        layout.prop(addonData, "is_background_cache_used")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_background_cache_used
+        sub.prop(addonData, "background_cache_margin")
+        sub.operator("myops.preprocessbackgrounds")
+        layout.prop(addonData, "is_overlay_rendered")
+
+        layout.prop(addonData, "is_flow_output")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_flow_output
+        sub.prop(addonData, "is_flow_occlusion")
+        sub.prop(addonData, "is_flow_depth")
 
         layout.separator()
         layout.prop(addonData, "is_init_target_moving")
@@ -1258,6 +3664,45 @@ class OfigenRunPanel( View3DPanel, bpy.types.Panel):
         addonData = context.scene.addon_data
         layout = self.layout
         layout.prop(addonData, "run_iterations", slider=True)
+        col = layout.column()
+        sub = col.row() 
+        sub.prop(addonData, "run_seed")
+        sub.prop(addonData, "is_resume")
+        layout.prop(addonData, "is_animation_render")
+        layout.prop(addonData, "is_persistent_data")
+        col = layout.column()
+        sub = col.row() 
+        sub.prop(addonData, "orphan_purge_interval")
+        sub.prop(addonData, "memory_limit")
+        layout.prop(addonData, "render_profile")
+        col = layout.column()
+        sub = col.row() 
+        sub.prop(addonData, "calibration_psnr")
+        sub.operator("myops.calibrate")
+        layout.prop(addonData, "is_async_output")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_async_output
+        sub.prop(addonData, "output_threads")
+        sub.prop(addonData, "output_queue_size")
+        col = layout.column()
+        sub = col.row() 
+        sub.prop(addonData, "image_format")
+        sub = col.row() 
+        sub.enabled = addonData.image_format != 'SCENE'
+        sub.prop(addonData, "image_color_depth")
+        sub.prop(addonData, "png_compression", slider=True)
+        layout.prop(addonData, "annotation_backend")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.annotation_backend != 'JSONL'
+        sub.prop(addonData, "annotation_shard_size")
+        layout.prop(addonData, "is_tar_output")
+        col = layout.column()
+        sub = col.row() 
+        sub.enabled = addonData.is_tar_output
+        sub.prop(addonData, "tar_shard_size")
+        sub.prop(addonData, "is_tar_loose_deleted")
         layout.operator("myops.run")
 
 
@@ -1326,6 +3771,16 @@ def register():
     bpy.types.Scene.addon_data = PointerProperty(type=AddonData)
 
 
+# Background mode (see ofigen_batch.py): only the data is registered, no UI.
+def registerHeadless():
+    bpy.utils.register_class(AddonData)
+    bpy.types.Scene.addon_data = PointerProperty(type=AddonData)
+
+def unregisterHeadless():
+    bpy.utils.unregister_class(AddonData)
+    del bpy.types.Scene.addon_data
+
+
 def unregister():
     bpy.utils.unregister_module(__name__)
     del bpy.types.Scene.addon_data
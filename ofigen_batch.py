@@ -0,0 +1,163 @@
+###################################
+## OFIGEN - headless batch runner
+##
+## Runs the generation without the UI, e.g. on render nodes:
+##
+##   blender -b [scene.blend] -P ofigen_batch.py -- --output /data/out/ --models /assets/models/
+##           --bounds /assets/Bounding/ --backgrounds /assets/Background/ --start 0 --count 1000 --seed 7 [--resume | --overwrite] [--calibrate] [--preprocess_backgrounds] [--bake_library]
+##
+## Every AddonData property can be set with --<property_name> <value>, for example
+## --max_number_of_models 15 --is_camera_moving true
+
+
+import sys
+import os
+import argparse
+import traceback
+
+import bpy
+import addon_utils
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import addon_ofigen
+
+
+###################################
+## Arguments
+
+PATH_ARGUMENTS = {
+    'output': 'data_path_out',
+    'models': 'data_path_objs',
+    'bounds': 'data_path_bounds',
+    'backgrounds': 'data_path_imgs',
+}
+
+PRIVATE_PROPERTIES = ('rna_type', 'name', 'numOfModels', 'background_file')
+
+
+def parseBool(text):
+    if text.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if text.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise argparse.ArgumentTypeError("Expected a boolean value, got: " + text)
+
+def getDataProperties():
+    return [prop for prop in addon_ofigen.AddonData.bl_rna.properties if prop.identifier not in PRIVATE_PROPERTIES]
+
+def getArgv():
+    if '--' in sys.argv:
+        return sys.argv[sys.argv.index('--') + 1:]
+    return []
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog="blender -b -P ofigen_batch.py --", description="Generate OFIGEN samples in background mode.")
+
+    parser.add_argument('--output', help="Output directory. (data_path_out)")
+    parser.add_argument('--models', help="Model database directory. (data_path_objs)")
+    parser.add_argument('--bounds', help="Bounding shape directory. (data_path_bounds)")
+    parser.add_argument('--backgrounds', help="Background image directory. (data_path_imgs)")
+
+    parser.add_argument('--start', type=int, default=0, help="Index of the first sample.")
+    parser.add_argument('--count', type=int, default=None, help="Number of samples. (default: run_iterations)")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the run. (run_seed)")
+    parser.add_argument('--resume', action='store_true', help="Skip the samples already complete in the output directory. (is_resume)")
+    parser.add_argument('--overwrite', action='store_true', help="Replace the samples of a previous run in the output directory.")
+    parser.add_argument('--refresh_index', action='store_true', help="Scan the asset directories again instead of using the cached index.")
+    parser.add_argument('--basename', default="img", help="Base name of the output files.")
+    parser.add_argument('--bake_library', action='store_true', help="Bake the models of the model directory (current filters) into a .blend library before the run and load them from it. (is_baked_library_used)")
+    parser.add_argument('--preprocess_backgrounds', action='store_true', help="Convert every background into the cache before the run and load them from it. (is_background_cache_used)")
+    parser.add_argument('--calibrate', action='store_true', help="Select the render profile by rendering the first sample with every profile before the run. (calibration_psnr)")
+
+    for prop in getDataProperties():
+        name = '--' + prop.identifier
+        if prop.type == 'BOOLEAN':
+            parser.add_argument(name, type=parseBool, help=prop.description)
+        elif prop.type == 'INT':
+            parser.add_argument(name, type=int, help=prop.description)
+        elif prop.type == 'FLOAT':
+            parser.add_argument(name, type=float, help=prop.description)
+        elif prop.type == 'ENUM':
+            parser.add_argument(name, choices=[item.identifier for item in prop.enum_items], help=prop.description)
+        else:
+            parser.add_argument(name, help=prop.description)
+
+    return parser.parse_args(argv)
+
+def asDirectory(path):
+    return os.path.join(os.path.abspath(path), "")
+
+def applyArguments(addonData, args):
+    for prop in getDataProperties():
+        value = getattr(args, prop.identifier)
+        if value != None:
+            setattr(addonData, prop.identifier, value)
+
+    for arg, identifier in PATH_ARGUMENTS.items():
+        value = getattr(args, arg)
+        if value != None:
+            setattr(addonData, identifier, value)
+
+    for identifier in PATH_ARGUMENTS.values():
+        setattr(addonData, identifier, asDirectory(getattr(addonData, identifier)))
+
+    if args.seed != None:
+        addonData.run_seed = args.seed
+    if args.resume:
+        addonData.is_resume = True
+
+
+
+
+def hasRunRecords(directory):
+    path = os.path.join(directory, addon_ofigen.MANIFEST_NAME)
+    return os.path.isfile(path) and os.path.getsize(path) > 0
+
+
+
+
+###################################
+## Run
+
+def main():
+    addon_utils.enable("io_import_images_as_planes")
+    addon_ofigen.registerHeadless()
+
+    args = parseArguments(getArgv())
+
+    context = bpy.context
+    addonData = context.scene.addon_data
+    applyArguments(addonData, args)
+
+    if not os.path.isdir(addonData.data_path_out):
+        os.makedirs(addonData.data_path_out)
+    # The records of a previous run are dropped when the run does not resume.
+    if hasRunRecords(addonData.data_path_out) and not (addonData.is_resume or args.overwrite):
+        print("The output directory holds the samples of a previous run, use --resume or --overwrite:", addonData.data_path_out)
+        sys.exit(1)
+
+    if args.refresh_index:
+        addon_ofigen.refreshAssetIndex(context, True)
+
+    if args.bake_library:
+        addon_ofigen.refreshAssetIndex(context)
+        addon_ofigen.bakeModelLibrary(context)
+
+    if args.preprocess_backgrounds:
+        addon_ofigen.refreshAssetIndex(context)
+        addon_ofigen.preprocessBackgrounds(context)
+
+    if args.calibrate:
+        addon_ofigen.refreshAssetIndex(context)
+        addon_ofigen.calibrateRenderProfile(context, args.start)
+
+    count = args.count if args.count != None else addonData.run_iterations
+    addon_ofigen.RunRange(context, args.basename, "", args.start, args.start + count)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
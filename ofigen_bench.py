@@ -0,0 +1,297 @@
+###################################
+## OFIGEN - benchmark
+##
+## Measures the import, placement, annotation and render throughput on the assets
+## of the repository (Models/, MultiModels/, Bounding/, Background/) with fixed
+## seeds and scene sizes, so two revisions can be compared on the same machine:
+##
+##   blender -b -P ofigen_bench.py -- [--save-baseline]
+##   blender -b -P ofigen_bench.py -- --samples 5 --sizes 1 5 15 --seed 7 --no-render
+##
+## The results are written to --results. With a baseline (--baseline, written by
+## --save-baseline on the reference revision) every timing is compared to it and
+## the run exits with 1 if one got slower than the tolerance allows.
+
+
+import sys
+import os
+import argparse
+import json
+import platform
+import tempfile
+import time
+import traceback
+
+import bpy
+import addon_utils
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+import addon_ofigen
+
+
+MODEL_SETS = ('Models', 'MultiModels')
+SIZES = (1, 5, 15)
+IMPORTERS = ('io_import_images_as_planes', 'io_scene_obj', 'io_mesh_stl', 'io_mesh_ply', 'io_scene_3ds')
+
+BASELINE_FILE = os.path.join(ROOT, "ofigen_bench_baseline.json")
+RESULTS_FILE = "ofigen_bench.json"
+
+
+###################################
+## Arguments
+
+def getArgv():
+    if '--' in sys.argv:
+        return sys.argv[sys.argv.index('--') + 1:]
+    return []
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog="blender -b -P ofigen_bench.py --", description="Benchmark OFIGEN on the assets of the repository.")
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), "ofigen_bench", ""), help="Directory of the results and the temporary files.")
+    parser.add_argument('--results', default=RESULTS_FILE, help="File name of the results in the output directory.")
+    parser.add_argument('--samples', type=int, default=3, help="Samples per case.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help="Number of targets of the cases.")
+    parser.add_argument('--model_sets', nargs='+', default=list(MODEL_SETS), help="Model directories of the repository.")
+    parser.add_argument('--seed', type=int, default=7, help="Run seed of every case.")
+    parser.add_argument('--render_profile', default='DRAFT', choices=['CUSTOM', 'DRAFT', 'PREVIEW', 'PRODUCTION'], help="Render profile of the render measurement.")
+    parser.add_argument('--baked-library', dest='baked_library', action='store_true', help="Bake the model sets first and load the models from the baked library.")
+    parser.add_argument('--no-render', dest='render', action='store_false', help="Skip the render measurement.")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline results to compare with.")
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true', help="Write the results as the new baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown against the baseline. (0.25: 25%%)")
+    return parser.parse_args(argv)
+
+
+
+
+###################################
+## Cases
+
+def configure(addonData, args, modelSet, size):
+    addonData.data_path_out = os.path.join(os.path.abspath(args.output), "")
+    addonData.data_path_objs = os.path.join(ROOT, modelSet, "")
+    addonData.data_path_bounds = os.path.join(ROOT, "Bounding", "")
+    addonData.data_path_imgs = os.path.join(ROOT, "Background", "")
+
+    addonData.is_format_obj = True
+    addonData.is_format_stl = True
+    addonData.is_format_ply = True
+    addonData.is_format_3ds = True
+    addonData.is_shape_box = True
+    addonData.is_shape_sphere = True
+    addonData.filename_model_tag = ""
+    addonData.filename_background_tag = ""
+
+    addonData.max_number_of_models = size
+    addonData.is_random_number_of_models = False
+    addonData.is_model_library_used = True
+    addonData.is_baked_library_used = args.baked_library
+    addonData.is_persistent_rig = True
+    addonData.is_async_output = False
+    addonData.render_profile = args.render_profile
+    addonData.run_seed = args.seed
+
+def resetSession(context):
+    addon_ofigen.clearScene(context)
+    addon_ofigen.clearModelLibrary()
+    addon_ofigen.clearBoundLibrary()
+    addon_ofigen.resetModelLibraryStats()
+    addon_ofigen.refreshAssetIndex(context)
+
+# Every model of the set is imported once into an empty library.
+def measureImport(context):
+    files = context.scene.addon_data.getModelFileNames()
+    seconds = {}
+    for filePath in files:
+        started = time.perf_counter()
+        addon_ofigen.getLibraryModel(filePath)
+        seconds[os.path.basename(filePath)] = time.perf_counter() - started
+    addon_ofigen.clearModelLibrary()
+
+    total = sum(seconds.values())
+    return {
+        "files": len(files),
+        "seconds": total,
+        "per_file": total / len(files) if len(files) > 0 else 0.0,
+        "per_model": seconds,
+    }
+
+# The samples are built with the seeds of the run, so every revision measures
+# the same scenes. The first sample imports the models into the library.
+def measureSamples(context, args):
+    records = []
+    started = time.perf_counter()
+
+    for idx in range(args.samples):
+        addon_ofigen.resetSampleMetrics()
+        sampleStarted = time.perf_counter()
+
+        addon_ofigen.buildSample(context, idx)
+        with addon_ofigen.StageTimer('annotation'):
+            addon_ofigen.extractPictureData(context, addon_ofigen.TARGET_NAME, addon_ofigen.CAM_NAME, addon_ofigen.IMG_NAME)
+        if args.render:
+            addon_ofigen.applyRenderSettings(context)
+            with addon_ofigen.StageTimer('render'):
+                addon_ofigen.renderCapture(context)
+        addon_ofigen.countStage('targets', context.scene.addon_data.numOfModels)
+        addon_ofigen.releaseSample(context)
+
+        records.append({
+            "index": idx,
+            "seconds": time.perf_counter() - sampleStarted,
+            "stages": addon_ofigen.SAMPLE_METRICS['stages'],
+            "counts": addon_ofigen.SAMPLE_METRICS['counts'],
+        })
+
+    return addon_ofigen.summarizeMetrics(records, time.perf_counter() - started)
+
+def getThroughput(summary):
+    stages = summary["stages"]
+    counts = summary["counts"]
+    targets = counts.get('targets', 0)
+
+    def perSecond(count, stage):
+        seconds = stages.get(stage, {}).get("total", 0.0)
+        return count / seconds if seconds > 0 else None
+
+    return {
+        "samples_per_second": summary["samples_per_second"],
+        "placements_per_second": perSecond(targets, 'placement'),
+        "annotations_per_second": perSecond(summary["samples"], 'annotation'),
+        "renders_per_second": perSecond(summary["samples"], 'render'),
+    }
+
+def runCase(context, args, modelSet, size):
+    configure(context.scene.addon_data, args, modelSet, size)
+    resetSession(context)
+    if args.baked_library:
+        addon_ofigen.bakeModelLibrary(context)
+
+    importResult = measureImport(context)
+    summary = measureSamples(context, args)
+    resetSession(context)
+
+    return {
+        "model_set": modelSet,
+        "size": size,
+        "import": importResult,
+        "samples": summary,
+        "throughput": getThroughput(summary),
+    }
+
+
+
+
+###################################
+## Baseline
+
+# Timings compared with the baseline: seconds per import and p50 per stage.
+def getTimings(results):
+    timings = {}
+    for name, case in results["cases"].items():
+        timings[name + ":import"] = case["import"]["per_file"]
+        for stage, values in case["samples"]["stages"].items():
+            timings[name + ":" + stage] = values["p50"]
+    return timings
+
+def compareWithBaseline(results, baseline, tolerance):
+    current = getTimings(results)
+    reference = getTimings(baseline)
+    regressions = []
+
+    print("\nCompared with the baseline of", baseline.get("created", "?"))
+    for key in sorted(current):
+        if key not in reference or reference[key] <= 0:
+            continue
+        ratio = current[key] / reference[key]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  <-- REGRESSION"
+            regressions.append(key)
+        print("   ", key.ljust(32), "{:10.2f} ms".format(1000 * reference[key]), "->", "{:10.2f} ms".format(1000 * current[key]), "({:+.0f}%)".format(100 * (ratio - 1)) + flag)
+    return regressions
+
+def isComparable(results, baseline):
+    for key in ('samples', 'seed', 'render_profile', 'render', 'baked_library', 'blender'):
+        if results["settings"].get(key) != baseline.get("settings", {}).get(key):
+            print("\nThe baseline was measured with other settings (" + key + "), it is not compared.")
+            return False
+    return True
+
+
+
+
+###################################
+## Run
+
+def enableImporters():
+    for module in IMPORTERS:
+        addon_utils.enable(module)
+
+def writeJSON(path, data):
+    with open(path, 'w') as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+
+def main():
+    args = parseArguments(getArgv())
+    enableImporters()
+    addon_ofigen.registerHeadless()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    context = bpy.context
+    results = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": {"node": platform.node(), "processor": platform.processor(), "system": platform.platform()},
+        "settings": {
+            "samples": args.samples,
+            "seed": args.seed,
+            "render_profile": args.render_profile,
+            "render": args.render,
+            "baked_library": args.baked_library,
+            "blender": bpy.app.version_string,
+        },
+        "cases": {},
+    }
+
+    for modelSet in args.model_sets:
+        for size in args.sizes:
+            name = modelSet + "/" + str(size)
+            print("\nBenchmark:", name)
+            results["cases"][name] = runCase(context, args, modelSet, size)
+            addon_ofigen.printMetricsSummary(results["cases"][name]["samples"])
+
+    writeJSON(os.path.join(args.output, args.results), results)
+    print("\nResults:", os.path.join(args.output, args.results))
+
+    if args.save_baseline:
+        writeJSON(args.baseline, results)
+        print("Baseline saved:", args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline at", args.baseline, "- run with --save-baseline on the reference revision first.")
+        return 0
+
+    with open(args.baseline, 'r') as fh:
+        baseline = json.load(fh)
+    if not isComparable(results, baseline):
+        return 0
+
+    regressions = compareWithBaseline(results, baseline, args.tolerance)
+    if len(regressions) > 0:
+        print("\n" + str(len(regressions)), "timings are slower than the baseline by more than", "{:.0f}%".format(100 * args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except SystemExit:
+        raise
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,332 @@
+###################################
+## OFIGEN - multi process generation
+##
+## Splits a sample range into disjoint shards, generates each shard with its own
+## background Blender process (ofigen_batch.py), then merges the shard outputs
+## into one dataset directory with a manifest. Runs with the system python:
+##
+##   python ofigen_farm.py --blender /opt/blender/blender --scene scene.blend --workers 16
+##          --output /data/run1/ --start 0 --count 100000 --seed 7 -- --models /assets/models/ ...
+##
+## Everything after '--' is passed to every worker (see ofigen_batch.py).
+
+
+import sys
+import os
+import argparse
+import collections
+import json
+import multiprocessing
+import subprocess
+import time
+
+
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ofigen_batch.py")
+SHARDS_FOLDER = "shards"
+MANIFEST_FILE = "manifest.json"
+SAMPLES_FILE = "samples.jsonl"
+CONFIG_PREFIX = "config_"
+ANNOTATION_PREFIX = "annotations_"
+TAR_PREFIX = "shard-"
+TAR_INDEX_FILE = "shards.jsonl"
+CALIBRATION_FILE = "calibration.json"
+METRICS_FILE = "metrics.jsonl"
+METRICS_SUMMARY_FILE = "metrics_summary.json"
+LOG_FILE = "worker.log"
+
+
+###################################
+## Shards
+
+class Shard:
+   def __init__(self, index, start, stop, seed, directory):
+        self.index = index
+        self.start = start
+        self.stop = stop
+        self.seed = seed
+        self.directory = directory
+        self.process = None
+        self.log = None
+        self.attempts = 0
+        self.returncode = None
+
+   def getKey(self):
+        return (self.start, self.stop, self.seed)
+
+
+def splitRange(start, count, workers):
+    workers = max(1, min(workers, count))
+    size, rest = divmod(count, workers)
+    ranges = []
+    first = start
+    for i in range(workers):
+        last = first + size + (1 if i < rest else 0)
+        ranges.append((first, last))
+        first = last
+    return ranges
+
+def createShards(args):
+    shards = []
+    for i, (start, stop) in enumerate(splitRange(args.start, args.count, args.workers)):
+        directory = os.path.join(args.output, SHARDS_FOLDER, "shard_%03d" % i, "")
+        shards.append(Shard(i, start, stop, args.seed, directory))
+    return shards
+
+# Every sample is seeded from the run seed and its own index, so the shards
+# share the seed and a restarted worker resumes where it stopped.
+def getWorkerCommand(args, shard, threads):
+    command = [args.blender, '-b']
+    if args.scene:
+        command.append(args.scene)
+    command = command + ['-t', str(threads), '-P', BATCH_SCRIPT, '--',
+        '--output', shard.directory,
+        '--start', str(shard.start),
+        '--count', str(shard.stop - shard.start),
+        '--seed', str(shard.seed),
+        '--basename', args.basename]
+    if args.resume or shard.attempts > 1:
+        command.append('--resume')
+    else:
+        command.append('--overwrite')
+    return command + args.worker_args
+
+def startShard(args, shard, threads):
+    if not os.path.isdir(shard.directory):
+        os.makedirs(shard.directory)
+    shard.attempts = shard.attempts + 1
+    shard.log = open(os.path.join(shard.directory, LOG_FILE), 'a')
+    shard.process = subprocess.Popen(getWorkerCommand(args, shard, threads), stdout=shard.log, stderr=subprocess.STDOUT)
+
+def countDoneSamples(shard):
+    try:
+        with open(os.path.join(shard.directory, SAMPLES_FILE), 'rb') as fh:
+            return sum(1 for line in fh)
+    except (IOError, OSError):
+        return 0
+
+
+
+
+###################################
+## Monitor
+
+def runShards(args, shards):
+    if len(shards) == 0:
+        return
+    threads = args.threads if args.threads > 0 else max(1, multiprocessing.cpu_count() // len(shards))
+    for shard in shards:
+        startShard(args, shard, threads)
+
+    running = list(shards)
+    lastReport = 0
+    while len(running) > 0:
+        time.sleep(1)
+
+        for shard in list(running):
+            code = shard.process.poll()
+            if code == None:
+                continue
+            shard.log.close()
+            if code != 0 and shard.attempts <= args.retries:
+                print("Shard", shard.index, "failed with", code, "- restarting (attempt", shard.attempts + 1, ")")
+                startShard(args, shard, threads)
+                continue
+            shard.returncode = code
+            running.remove(shard)
+            print("Shard", shard.index, "finished with", code)
+
+        if time.time() - lastReport > args.report_interval:
+            lastReport = time.time()
+            done = sum([countDoneSamples(shard) for shard in shards])
+            print("Progress:", done, "/", args.count, "samples,", len(running), "workers running")
+
+
+
+
+###################################
+## Merge
+
+def getSampleName(filename):
+    return filename.split('.')[0]
+
+def readManifest(args):
+    try:
+        with open(os.path.join(args.output, MANIFEST_FILE), 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+# On resume, the shards merged by a previous run (same range and seed) are not
+# started again, their outputs are already in the dataset directory.
+def getMergedShards(args, manifest):
+    if not args.resume or manifest == None:
+        return {}
+    return dict([((info["start"], info["stop"], info["seed"]), info) for info in manifest["shards"] if info.get("merged")])
+
+# The records are keyed by their sample name, the last one of a name is kept.
+def readSampleRecords(path, records):
+    count = 0
+    try:
+        with open(path, 'r') as fh:
+            for line in fh:
+                try:
+                    name = json.loads(line).get("name")
+                except (ValueError, AttributeError):
+                    continue
+                records.pop(name, None)
+                records[name] = line if line.endswith('\n') else line + '\n'
+                count = count + 1
+    except (IOError, OSError):
+        pass
+    return count
+
+def writeSampleRecords(path, records):
+    with open(path + ".tmp", 'w') as fh:
+        fh.writelines(records.values())
+    os.replace(path + ".tmp", path)
+
+# Only the shards that succeeded are merged, a failed shard directory is left
+# as it is so the next run with --resume continues it. The sample records, the
+# tar indexes and the metrics of the dataset are rebuilt with the records of
+# the shards (one per sample, a sample generated again replaces its record),
+# the per shard summaries stay in the shard directories. The run configs are
+# shared (their name is their hash), the rest is moved. The NumPy annotation
+# and tar shards are named after their first sample, they never collide.
+def mergeShards(args, shards):
+    previous = readManifest(args)
+    mergedShards = getMergedShards(args, previous)
+    samples = {}
+    if previous != None:
+        samples = dict([(sample["name"], sample["files"]) for sample in previous["samples"]])
+    shardInfo = []
+    recordFiles = (SAMPLES_FILE, TAR_INDEX_FILE, METRICS_FILE)
+    records = dict([(filename, collections.OrderedDict()) for filename in recordFiles])
+    for filename in recordFiles:
+        readSampleRecords(os.path.join(args.output, filename), records[filename])
+    merged = []
+
+    for shard in shards:
+        if shard.getKey() in mergedShards:
+            shardInfo.append(mergedShards[shard.getKey()])
+            continue
+
+        moved = 0
+        recordCount = 0
+        annotations = []
+        tars = []
+        for filename in sorted(os.listdir(shard.directory)) if shard.returncode == 0 else []:
+            source = os.path.join(shard.directory, filename)
+            if filename in (LOG_FILE, METRICS_SUMMARY_FILE) or not os.path.isfile(source):
+                continue
+            if filename in recordFiles:
+                count = readSampleRecords(source, records[filename])
+                if filename == SAMPLES_FILE:
+                    recordCount = count
+                merged.append(source)
+                continue
+            os.replace(source, os.path.join(args.output, filename))
+            if filename.startswith(ANNOTATION_PREFIX):
+                annotations.append(filename)
+            elif filename.startswith(TAR_PREFIX):
+                tars.append(filename)
+            elif not filename.startswith(CONFIG_PREFIX) and filename != CALIBRATION_FILE:
+                files = samples.setdefault(getSampleName(filename), [])
+                if filename not in files:
+                    files.append(filename)
+            moved = moved + 1
+
+        shardInfo.append({
+            "index": shard.index,
+            "start": shard.start,
+            "stop": shard.stop,
+            "seed": shard.seed,
+            "attempts": shard.attempts,
+            "returncode": shard.returncode,
+            "merged": shard.returncode == 0,
+            "files": moved,
+            "records": recordCount,
+            "annotations": annotations,
+            "tars": tars,
+        })
+
+    # The shard records are removed once the dataset records are written.
+    for filename in recordFiles:
+        writeSampleRecords(os.path.join(args.output, filename), records[filename])
+    for source in merged:
+        os.remove(source)
+
+    manifest = {
+        "basename": args.basename,
+        "start": args.start,
+        "count": args.count,
+        "seed": args.seed,
+        "workers": len(shards),
+        "shards": shardInfo,
+        "records": SAMPLES_FILE,
+        "samples": [{"name": name, "files": samples[name]} for name in sorted(samples)],
+    }
+    with open(os.path.join(args.output, MANIFEST_FILE + ".tmp"), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(os.path.join(args.output, MANIFEST_FILE + ".tmp"), os.path.join(args.output, MANIFEST_FILE))
+
+    return manifest
+
+
+
+
+###################################
+## Run
+
+def getArgv():
+    if '--' in sys.argv:
+        index = sys.argv.index('--')
+        return sys.argv[1:index], sys.argv[index + 1:]
+    return sys.argv[1:], []
+
+def parseArguments():
+    own, workerArgs = getArgv()
+    parser = argparse.ArgumentParser(description="Generate OFIGEN samples with several background Blender processes.")
+    parser.add_argument('--blender', default="blender", help="Blender executable.")
+    parser.add_argument('--scene', default="", help=".blend file opened by the workers.")
+    parser.add_argument('--output', required=True, help="Dataset directory.")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Number of Blender processes.")
+    parser.add_argument('--threads', type=int, default=0, help="Render threads per worker. (0: cpu count / workers)")
+    parser.add_argument('--start', type=int, default=0, help="Index of the first sample.")
+    parser.add_argument('--count', type=int, required=True, help="Number of samples.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the run.")
+    parser.add_argument('--resume', action='store_true', help="Skip the shards already merged and keep the samples already complete in the shard directories of the failed ones.")
+    parser.add_argument('--basename', default="img", help="Base name of the output files.")
+    parser.add_argument('--retries', type=int, default=1, help="Restarts of a failed worker.")
+    parser.add_argument('--report_interval', type=float, default=30, help="Seconds between the progress reports.")
+    args = parser.parse_args(own)
+    args.output = os.path.join(os.path.abspath(args.output), "")
+    args.worker_args = workerArgs
+    return args
+
+def main():
+    args = parseArguments()
+    started = time.time()
+
+    shards = createShards(args)
+    mergedShards = getMergedShards(args, readManifest(args))
+    for shard in shards:
+        if shard.getKey() in mergedShards:
+            shard.returncode = 0
+    runShards(args, [shard for shard in shards if shard.getKey() not in mergedShards])
+    manifest = mergeShards(args, shards)
+
+    # Counted from the records, the loose files may be packed into tar shards.
+    generated = sum([shard["records"] for shard in manifest["shards"] if (shard["start"], shard["stop"], shard["seed"]) not in mergedShards])
+    elapsed = time.time() - started
+    print("Generated", generated, "samples in", "{:.1f}".format(elapsed), "s",
+        "({:.2f} samples/s)".format(generated / elapsed if elapsed > 0 else 0))
+
+    failed = [shard.index for shard in shards if shard.returncode != 0]
+    if len(failed) > 0:
+        print("Failed shards:", failed)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())